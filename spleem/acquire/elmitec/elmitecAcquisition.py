@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Double-buffered acquisition on top of oUview/oLeem.
+
+Three threads share a ring of preallocated frame slots:
+    producer  triggers acquisitions (asi) and snapshots the oLeem parameters
+    transfer  receives each frame (ida) straight into its ring slot
+    writer    persists finished slots in batches and hands them back
+
+startVoltageSweep drives the pipeline through a list of start voltages.
+
+The frames are written as .tif with the .txt metadata sidecar read by
+spleem.analyze.spleem.Frame, so the output folder loads as an Image or Sweep. A
+spin-resolved startVoltageSweep writes [SPINUP]/[SPINDN]/[SPLEEM] tagged frames
+instead, which load as a SpinSweep.
+"""
+
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# PIL is imported by writeFrame, so importing the pipeline loads no image library
+
+_STOP = None
+
+
+def _formatValue(value):
+    # Frame keeps only digits, "." and "-" of a value, so write no exponents
+    if value is None:
+        return "ValueNotAvailable"
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return np.format_float_positional(value, trim="-")
+    return str(value)
+
+
+def writeFrame(folder, index, img, parameters, startVoltage=None, label="img"):
+    """Writes one frame as <index>-<label>-.tif plus the <index>.txt metadata file
+    that Frame pairs with it. parameters maps module names to values."""
+    from PIL import Image as Tif
+
+    fileName = f"{index:04d}-{label}-.tif"
+    Tif.fromarray(img).save(os.path.join(folder, fileName))
+
+    lines = [
+        f"directory: {folder}",
+        f"file: {fileName}",
+        f"index: {index}",
+        f"time: {time.strftime('%H:%M:%S')}",
+        f"Start_Voltage: {_formatValue(startVoltage)}",
+    ]
+    for name, value in parameters.items():
+        key = str(name).replace(":", "_")
+        lines.append(f"{key}: {_formatValue(value)}")
+    with open(os.path.join(folder, f"{index:04d}.txt"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+class acquisitionPipeline:
+    """Acquires nFrames into folder while transfers and disk writes run in the
+    background. UView serves its most recent image, so the next acquisition is
+    triggered as soon as the previous frame has been received and disk writes
+    overlap with the exposure. While it runs, the oLeem parameter cache (chm
+    polling every pollInterval seconds) is kept running, so the parameter snapshot
+    taken before each trigger is a dict copy rather than a round trip per module."""
+
+    def __init__(
+        self,
+        uview,
+        folder,
+        leem=None,
+        nSlots=8,
+        batchSize=4,
+        startVoltageModule="Start Voltage",
+        label="img",
+        pollInterval=0.2,
+        write=True,
+    ):
+        self.uview = uview
+        self.leem = leem
+        self.folder = folder
+        self.pollInterval = pollInterval
+        # with write=False persisting the frames is left to the listeners
+        self.write = write
+        self.nSlots = nSlots
+        self.batchSize = batchSize
+        self.startVoltageModule = startVoltageModule
+        self.label = label
+        self.listeners = []
+        xs, ys = uview.getCameraSize()
+        self.slots = np.empty((nSlots, ys, xs), dtype="<u2")
+
+    def addListener(self, callback):
+        """Calls callback(index, img, parameters) from the writer thread for every
+        frame, before its slot is reused"""
+        self.listeners.append(callback)
+        return self
+
+    def run(self, nFrames, firstIndex=1, acquire=None):
+        """Acquires nFrames and returns the per-stage timing statistics.
+
+        acquire(index) replaces the plain acquireSingleImg trigger and returns the
+        start voltage of the frame, which lets a sweep set up each step itself."""
+        os.makedirs(self.folder, exist_ok=True)
+        self.freeSlots = queue.Queue()
+        for slot in range(self.nSlots):
+            self.freeSlots.put(slot)
+        self.acquired = queue.Queue()
+        self.transferred = queue.Queue()
+        self.cameraFree = threading.Semaphore(1)
+        self.errors = []
+        self.stats = {"acquire": 0.0, "transfer": 0.0, "write": 0.0, "frames": 0}
+
+        threads = [
+            threading.Thread(
+                target=self._guard,
+                args=(self._produce, nFrames, firstIndex, acquire),
+            ),
+            threading.Thread(target=self._guard, args=(self._transfer,)),
+            threading.Thread(target=self._guard, args=(self._write,)),
+        ]
+        # leave a parameter cache that was already running to its owner
+        ownsCache = self.leem is not None and self.leem.cacheInterval is None
+        if ownsCache:
+            self.leem.startParameterCache(self.pollInterval)
+        t0 = time.perf_counter()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if ownsCache:
+                self.leem.stopParameterCache()
+        self.stats["elapsed"] = time.perf_counter() - t0
+        self.stats["framesPerHour"] = (
+            3600 * self.stats["frames"] / self.stats["elapsed"]
+        )
+
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
+
+    def _guard(self, stage, *args):
+        try:
+            stage(*args)
+        except Exception as e:
+            self.errors.append(e)
+            # unblock the other stages so run() can return
+            self.freeSlots.put(0)
+            self.acquired.put(_STOP)
+            self.transferred.put(_STOP)
+            self.cameraFree.release()
+
+    def _produce(self, nFrames, firstIndex, acquire):
+        for index in range(firstIndex, firstIndex + nFrames):
+            slot = self.freeSlots.get()
+            self.cameraFree.acquire()
+            if self.errors:
+                return
+            parameters = {} if self.leem is None else self.leem.snapshot()
+            t = time.perf_counter()
+            if acquire is None:
+                self.uview.acquireSingleImg()
+                startVoltage = None
+            else:
+                startVoltage = acquire(index)
+            self.stats["acquire"] += time.perf_counter() - t
+            if startVoltage is None:
+                startVoltage = parameters.get(self.startVoltageModule)
+            elif self.startVoltageModule in parameters:
+                # the cache may not have seen a voltage that was just set yet
+                parameters[self.startVoltageModule] = startVoltage
+            self.acquired.put((index, slot, parameters, startVoltage))
+        self.acquired.put(_STOP)
+
+    def _transfer(self):
+        while (item := self.acquired.get()) is not _STOP:
+            index, slot, parameters, startVoltage = item
+            t = time.perf_counter()
+            self.uview.getImage(out=self.slots[slot])
+            self.stats["transfer"] += time.perf_counter() - t
+            self.cameraFree.release()
+            self.transferred.put(item)
+        self.transferred.put(_STOP)
+
+    def _write(self):
+        done = False
+        while not done:
+            batch = [self.transferred.get()]
+            # take whatever else is already waiting, up to a full batch
+            while len(batch) < self.batchSize and not self.transferred.empty():
+                batch.append(self.transferred.get())
+            if _STOP in batch:
+                done = True
+                batch = batch[: batch.index(_STOP)]
+
+            t = time.perf_counter()
+            for index, slot, parameters, startVoltage in batch:
+                img = self.slots[slot]
+                if self.write:
+                    writeFrame(
+                        self.folder, index, img, parameters, startVoltage, self.label
+                    )
+                for callback in self.listeners:
+                    callback(index, img, parameters)
+            self.stats["write"] += time.perf_counter() - t
+            self.stats["frames"] += len(batch)
+            for _index, slot, _parameters, _startVoltage in batch:
+                self.freeSlots.put(slot)
+
+
+class startVoltageSweep:
+    """Steps the start voltage through voltages and acquires imagesPerStep frames
+    at each step into folder, which then loads as a spleem.analyze.spleem.Sweep.
+
+    The next voltage is set as soon as the last frame of a step has been
+    acquired, so it settles while that frame is transferred and written; before
+    each acquisition only the remaining settle time is waited for. exposure and
+    averaging are single values or one value per step.
+
+    Given a spinModule, every image is taken twice, with spinModule set to the
+    spin up and the spin down value of spinValues. The pair is written as
+    <index>-[SPINUP]-.tif and <index>-[SPINDN]-.tif plus their float32 difference
+    (up - down) as <index>-[SPLEEM]-.tif, so the folder loads as a SpinSweep.
+    The shared <index>.txt holds the parameters of the spin down frame.
+    """
+
+    def __init__(
+        self,
+        leem,
+        uview,
+        folder,
+        voltages,
+        exposure=None,
+        averaging=None,
+        imagesPerStep=1,
+        module="Start Voltage",
+        settleTime=None,
+        nSlots=8,
+        spinModule=None,
+        spinValues=(1, -1),
+    ):
+        self.leem = leem
+        self.uview = uview
+        self.folder = folder
+        self.voltages = list(voltages)
+        self.exposure = self._perStep(exposure)
+        self.averaging = self._perStep(averaging)
+        self.imagesPerStep = imagesPerStep
+        self.module = module
+        self.spinModule = spinModule
+        self.spinValues = spinValues
+        self.framesPerImage = 1 if spinModule is None else 2
+        if settleTime is not None:
+            leem.setSettleTime(module, settleTime)
+        self.pipeline = acquisitionPipeline(
+            uview,
+            folder,
+            leem=leem,
+            nSlots=nSlots,
+            startVoltageModule=module,
+            label="sw",
+            write=spinModule is None,
+        )
+        if spinModule is not None:
+            self.pipeline.addListener(self._writeSpinFrame)
+
+    def _perStep(self, plan):
+        if plan is None or np.ndim(plan) == 0:
+            return [plan] * len(self.voltages)
+        assert len(plan) == len(self.voltages), "Need one value per voltage step."
+        return list(plan)
+
+    def run(self):
+        """Runs the sweep and returns the per-step timing log, which is also written
+        to sweep_timing.csv in the output folder"""
+        self.log = []
+        self._upFrame = None
+        self._setStep(0)
+        stats = self.pipeline.run(
+            len(self.voltages) * self.imagesPerStep * self.framesPerImage,
+            acquire=self._acquire,
+        )
+        self._writeLog()
+        print(
+            f"Sweep of {len(self.voltages)} steps done in {stats['elapsed']:.1f} s "
+            f"({self.leem.settle.waited:.1f} s waiting for settling)"
+        )
+        return self.log
+
+    def _position(self, index):
+        """Returns (step, image, spin) of pipeline frame index; spin is 0 for up
+        and 1 for down, always 0 without a spin module"""
+        image, spin = divmod(index - 1, self.framesPerImage)
+        step, image = divmod(image, self.imagesPerStep)
+        return step, image, spin
+
+    def _setStep(self, step):
+        if self.exposure[step] is not None:
+            self.uview.setExposureTime(self.exposure[step])
+        if self.averaging[step] is not None:
+            self.uview.setAvr(self.averaging[step])
+        self.leem.setValue(self.module, self.voltages[step])
+
+    def _acquire(self, index):
+        step, image, spin = self._position(index)
+        t0 = time.perf_counter()
+        if self.spinModule is not None:
+            self.leem.setValue(self.spinModule, self.spinValues[spin])
+        settleWait = self.leem.settle.wait(self.leem.moduleNumber(self.module))
+        if self.spinModule is not None:
+            settleWait += self.leem.settle.wait(self.leem.moduleNumber(self.spinModule))
+        t1 = time.perf_counter()
+        self.uview.acquireSingleImg()
+        t2 = time.perf_counter()
+        # start settling the next voltage while this frame is transferred
+        lastOfStep = image == self.imagesPerStep - 1 and spin == self.framesPerImage - 1
+        if lastOfStep and step + 1 < len(self.voltages):
+            self._setStep(step + 1)
+        t3 = time.perf_counter()
+        entry = {
+            "index": index,
+            "voltage": self.voltages[step],
+            "settleWait": settleWait,
+            "acquire": t2 - t1,
+            "setNext": t3 - t2,
+            "step": t3 - t0,
+        }
+        if self.spinModule is not None:
+            entry["spin"] = ("up", "down")[spin]
+        self.log.append(entry)
+        return self.voltages[step]
+
+    def _writeSpinFrame(self, index, img, parameters):
+        """Pipeline listener writing the tagged frames of a spin-resolved sweep"""
+        step, _image, spin = self._position(index)
+        fileIndex = (index - 1) // 2 + 1
+        voltage = self.voltages[step]
+        if spin == 0:
+            # the slot is reused once the listeners return
+            self._upFrame = img.copy()
+            writeFrame(self.folder, fileIndex, img, parameters, voltage, "[SPINUP]")
+            return
+        writeFrame(self.folder, fileIndex, img, parameters, voltage, "[SPINDN]")
+        difference = self._upFrame.astype(np.float32) - img
+        writeFrame(self.folder, fileIndex, difference, parameters, voltage, "[SPLEEM]")
+
+    def _writeLog(self):
+        keys = list(self.log[0]) if self.log else []
+        with open(os.path.join(self.folder, "sweep_timing.csv"), "w") as f:
+            f.write(",".join(keys) + "\n")
+            for entry in self.log:
+                f.write(",".join(str(entry[key]) for key in keys) + "\n")
@@ -23,95 +23,143 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import socket
-import time
-import numpy as np
-import struct
+import os
 import sys
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ...analyze.imports import ReadUView
+from ...analyze.pyramid import bin_image, fitting_factor
+
+# tkinter, PIL and skimage are imported where they are used, so importing this
+# module loads nothing and opens no window
+
+DEFAULT_DATA_DIR = r"K:\Data\TurningPointResolution"
+
+
+def readStackImage(f, out=None) -> np.ndarray:
+    """Reads the first image of a .dat file, or a .tif, into out if given"""
+    if f.lower().endswith(".dat"):
+        return ReadUView().readImageInto(f, out)
+    import PIL.Image
+
+    img = np.asarray(PIL.Image.open(f))
+    if out is None:
+        return img
+    out[:] = img
+    return out
 
-# import readUview as ru
-from .readuview import readUview as ru
-import matplotlib.pyplot as plt
-from skimage import exposure
+
+def cumulativeHistogram(img) -> np.ndarray:
+    """Cumulative pixel count per intensity of an unsigned integer image, found
+    with one O(n) bincount instead of sorting the pixels. The counts are uint32,
+    enough for any single frame."""
+    return np.cumsum(np.bincount(img.ravel()), dtype=np.uint32)
+
+
+def histogramPercentiles(cumHist, q) -> np.ndarray:
+    """Intensities at the percentiles q, looked up in a cumulative histogram. Each
+    is the lowest intensity that at least q percent of the pixels do not exceed."""
+    target = np.maximum(np.asarray(q, dtype=float) / 100 * cumHist[-1], 1)
+    return np.searchsorted(cumHist, target).astype(float)
 
 
 class imgStackClass:
-    def __init__(self, fn) -> None:
+    # cumulative histograms kept for the most recently shown frames, up to 256 KB
+    # each for 16 bit images
+    histogramCacheSize = 64
+
+    def __init__(self, fn, workers=None) -> None:
         """Initializes the imgStackClass object"""
         # fn must be a list of file names to load as a numpy array
         if len(fn) < 1:
             print("Failed. No file loaded")
             return
         try:
-            self.imageWidth = 0
-            self.imageHeight = 0
             self.nImages = len(fn)
-            for f in fn:
-                ind = fn.index(f)
-                if ind == 0:
-                    ruObj = ru.readUviewClass()
-                    img = ruObj.getImage(f)
-                    self.imgType = img.dtype.name
-                    self.imageWidth = ruObj.imageWidth
-                    self.imageHeight = ruObj.imageHeight
-                    self.stack = np.zeros(
-                        (self.nImages, self.imageWidth, self.imageHeight),
-                        dtype=np.ndarray,
-                    )
-                    self.stack[0] = img
-                    self.limits = np.percentile(img, (2, 98))
-                    #                    print("Loading image nr=%04i" %ind, end='\r')
-                    print(f"\rLoading image nr=" + str("%04i" % ind), end="")
-                    sys.stdout.flush()
-                else:
-                    img = ruObj.getImage(f)
-                    self.imageWidth = ruObj.imageWidth
-                    self.imageHeight = ruObj.imageHeight
-                    try:
-                        self.stack[ind] = img
-                        #                        print("Loading image nr=%04i" %ind, end='\r')
-                        print(f"\rLoading image nr=" + str("%04i" % ind), end="")
-                        sys.stdout.flush()
-                    except:
-                        raise Exception("Error loading image nr".format(fn.index(f)))
-            print("\n")
+            img = readStackImage(fn[0])
+            self.imgType = img.dtype.name
+            self.imageHeight, self.imageWidth = img.shape
+            # one contiguous (n, h, w) block, every file is read straight into its
+            # slice by a pool of threads (file reads release the GIL)
+            self.stack = np.empty((self.nImages, *img.shape), dtype=img.dtype)
+            self.stack[0] = img
+            with ThreadPoolExecutor(workers) as executor:
+                for _ in executor.map(readStackImage, fn[1:], self.stack[1:]):
+                    pass
+            # cumulative histograms of recent frames, least recently used first
+            self.histograms = OrderedDict()
+            self.stackHistogram = None
+            self.limits = self.getLimits(0)
+            print(f"Loaded {self.nImages} images")
             self.current = 0
             self.fn = fn
             self.rawfn = []
             for f in fn:
                 self.rawfn.append(os.path.basename(os.path.abspath(f)) + ".dat")
             self.dir = os.path.dirname(os.path.abspath(self.fn[0]))
-        except:
-            print("Loading of images failed")
+        except Exception as e:
+            print(f"Loading of images failed: {e}")
             return
 
     def getImage(self, pos=-1) -> np.ndarray:
+        """Returns a view of the image at pos, copy it before modifying it"""
         if pos < 0:
             pos = self.current
         try:
-            return self.stack[pos].astype(self.imgType)
+            return self.stack[pos]
         except:
             raise Exception("Index not valid or stack not yet defined")
 
+    def getHistogram(self, pos=-1) -> np.ndarray:
+        """Cumulative histogram of the image at pos, computed once per frame"""
+        if pos < 0:
+            pos = self.current
+        if pos in self.histograms:
+            self.histograms.move_to_end(pos)
+        else:
+            self.histograms[pos] = cumulativeHistogram(self.getImage(pos))
+            while len(self.histograms) > self.histogramCacheSize:
+                self.histograms.popitem(last=False)
+        return self.histograms[pos]
+
     def getLimits(self, pos=-1, clip=2) -> tuple:
         if pos < 0:
             pos = self.current
         try:
-            self.limits = np.percentile(self.getImage(pos), (clip, 100 - clip))
+            if np.issubdtype(self.stack.dtype, np.unsignedinteger):
+                cumHist = self.getHistogram(pos)
+                self.limits = histogramPercentiles(cumHist, (clip, 100 - clip))
+            else:
+                self.limits = np.percentile(self.getImage(pos), (clip, 100 - clip))
             return self.limits
         except:
             raise Exception("Index not valid or stack not yet defined")
 
+    def getStackLimits(self, clip=2) -> tuple:
+        """Limits over the whole stack, from one merged histogram of all frames that
+        is built once; the frame histograms are not kept for it"""
+        if not np.issubdtype(self.stack.dtype, np.unsignedinteger):
+            return np.percentile(self.stack, (clip, 100 - clip))
+        if self.stackHistogram is None:
+            merged = np.zeros(int(self.stack.max()) + 1, dtype=np.int64)
+            for img in self.stack:
+                counts = np.bincount(img.ravel())
+                merged[: len(counts)] += counts
+            self.stackHistogram = np.cumsum(merged)
+        return histogramPercentiles(self.stackHistogram, (clip, 100 - clip))
+
     def getDrawImage(self, pos=-1, clip=2) -> np.ndarray:
         if pos < 0:
             pos = self.current
-        if clip != 2:
-            limits = np.percentile(self.getImage(pos), (2, 98))
-        else:
-            limits = self.limits
+        from skimage import exposure
+
+        limits = self.getLimits(pos, clip)
         try:
             img = exposure.rescale_intensity(
-                self.stack[pos].astype(self.imgType), in_range=(limits[0], limits[1])
+                self.getImage(pos), in_range=(limits[0], limits[1])
             )
             return img
         # .astype(self.imgType)
@@ -153,49 +201,119 @@ class elmitecAnalysisClass:
         self.dir = dirName
 
 
-import os
-
-
-def getDatFilesInDir(mypath=r"K:\Data\TurningPointResolution"):
+def getDatFilesInDir(mypath=DEFAULT_DATA_DIR):
     fileList = []
-    for file in os.listdir(mypath):
+    for file in sorted(os.listdir(mypath)):
         if file.endswith(".dat"):
             fileList.append(os.path.join(mypath, file))
     return fileList
 
 
-# Run examples
-fn = getDatFilesInDir()
-stack = imgStackClass(fn)
-
-
-# import pylab as pl
-# from IPython import display
-# from IPython import get_ipython
-# get_ipython().run_line_magic('matplotlib', 'qt5')
-
-# limits= stack.getLimits(pos=0,clip=2)
-##imgObj = plt.imshow(stack.getImage(0), cmap=plt.cm.gray, vmin=limits[0], vmax=limits[1])
-# fig,ax = plt.subplots(1,1)
-# ax.imshow(stack.getImage(0), cmap=plt.cm.gray, vmin=limits[0], vmax=limits[1])
-# fig.canvas.draw()
-# ax.imshow(stack.getImage(1), cmap=plt.cm.gray, vmin=limits[0], vmax=limits[1])
-
-# image = sitk.GetImageFromArray(stack.getImage(1), isVector=True)
-
-
-import tkinter as tk
-from tkinter import filedialog
-import PIL.Image, PIL.ImageTk
-import PIL.ImageOps
-
-# import cv2
-from skimage.transform import rescale
-from skimage import exposure
+def renderDisplayImage(stack, pos, winSize) -> "PIL.Image.Image":
+    """8-bit display image of frame pos, binned down to fit winSize and stretched
+    between the frame's 2/98 percent limits"""
+    import PIL.Image
+
+    img = stack.getImage(pos)
+    p2, p98 = stack.getLimits(pos)
+    if (stack.imageWidth > winSize[0]) or (stack.imageHeight > winSize[1]):
+        # bin straight to the largest pyramid level that fits, no resampling needed
+        binned = bin_image(img, fitting_factor(img.shape, winSize))
+        # binned pixels sum factor**2 pixels, scale the limits to match
+        area = img.size / binned.size
+        img, p2, p98 = binned, p2 * area, p98 * area
+    scale = 255 / max(p98 - p2, 1)
+    display = np.clip((img - p2) * scale, 0, 255).astype(np.uint8)
+    return PIL.Image.fromarray(display)
+
+
+class framePrefetcher:
+    """Renders display images on a worker thread and keeps the last cacheSize of
+    them. After a frame is requested, its neighbours up to radius frames away are
+    rendered too, nearest first, so stepping through the stack finds them ready."""
+
+    def __init__(self, render, cacheSize=16, radius=3):
+        self.render = render
+        self.radius = radius
+        # never evict the frames of the current request
+        self.cacheSize = max(cacheSize, 2 * radius + 1)
+        self.cache = OrderedDict()
+        self.wanted = []
+        self.generation = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def get(self, pos):
+        """Returns the rendered frame, or None if it is not ready yet"""
+        with self.condition:
+            if pos in self.cache:
+                self.cache.move_to_end(pos)
+                return self.cache[pos]
+        return None
+
+    def request(self, pos, nImages):
+        """Renders pos first, then its neighbours, replacing earlier requests"""
+        order = [pos]
+        for distance in range(1, self.radius + 1):
+            order += [pos + distance, pos - distance]
+        with self.condition:
+            self.wanted = [p for p in order if 0 <= p < nImages]
+            # the wanted frames already cached are the last to be evicted
+            for p in reversed(self.wanted):
+                if p in self.cache:
+                    self.cache.move_to_end(p)
+            self.condition.notify()
+
+    def clear(self):
+        with self.condition:
+            self.cache.clear()
+            self.wanted = []
+            self.generation += 1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def _next(self):
+        while self.wanted:
+            pos = self.wanted.pop(0)
+            if pos not in self.cache:
+                return pos
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: not self.running
+                    or any(p not in self.cache for p in self.wanted)
+                )
+                if not self.running:
+                    return
+                pos = self._next()
+                generation = self.generation
+            if pos is None:
+                continue
+            img = self.render(pos)
+            with self.condition:
+                if generation != self.generation:
+                    continue
+                self.cache[pos] = img
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
 
 
 class elmitecImageViewer:
-    def __init__(self, stack):
+    def __init__(self, stack=None):
+        """Opens the viewer on stack, an imgStackClass, or empty if stack is None so
+        that images are only loaded through the Open button. Blocks until the
+        window is closed."""
+        import tkinter as tk
+
         imgNr = 0
         self.winSize = (1024, 1024)
         self.winPadding = (100, 200)
@@ -219,54 +337,82 @@ class elmitecImageViewer:
         self.imageCanvas.pack(side=tk.RIGHT, expand=True)
         self.mainFrame.winfo_toplevel().title("Image number %04i" % imgNr)
 
-        for n, item in enumerate(self.stack.fn):
-            self.listbox.insert(tk.END, "{:04d} - {}".format(n, os.path.basename(item)))
         openButton = tk.Button(self.topFrame, text="Open", command=self.openImageList)
         openButton.grid(row=0, column=0, pady=20)
-        prevButton = tk.Button(self.topFrame, text="Previous")
+        prevButton = tk.Button(
+            self.topFrame, text="Previous", command=self.showPrevious
+        )
         prevButton.grid(row=0, column=2, pady=20)
-        nextButton = tk.Button(self.topFrame, text="Next")
+        nextButton = tk.Button(self.topFrame, text="Next", command=self.showNext)
         nextButton.grid(row=0, column=1, pady=20)
+        self.root.bind("<Left>", lambda evt: self.showPrevious())
+        self.root.bind("<Right>", lambda evt: self.showNext())
 
-        img = self.stack.getImage(imgNr)
-        p2, p98 = np.percentile(img, (2, 98))
-        img_rescale_int = exposure.rescale_intensity(
-            img, in_range=(p2, p98), out_range=(0, 255)
-        )
-        intensityFixedImg = PIL.Image.fromarray(img_rescale_int)
-        self.photo = PIL.ImageTk.PhotoImage(intensityFixedImg, master=self.root)
-
-        self.imageOnCanvas = self.imageCanvas.create_image(
-            0, 0, image=self.photo, anchor=tk.NW
+        # display images are rendered off the Tk thread, which only swaps them in
+        self.prefetcher = framePrefetcher(
+            lambda pos: renderDisplayImage(self.stack, pos, self.winSize)
         )
-        self.listbox.selection_clear(0, last=self.stack.nImages - 1)
-        self.listbox.selection_set(0)
+        self.photo = None
+        self.imageOnCanvas = self.imageCanvas.create_image(0, 0, anchor=tk.NW)
         self.windowRunning = True
+        if self.stack is not None:
+            self.setStack(self.stack)
         self.root.mainloop()
         self.windowRunning = False
+        self.prefetcher.stop()
+
+    def setStack(self, stack):
+        """Shows stack, an imgStackClass, from its first image"""
+        import tkinter as tk
+
+        self.stack = stack
+        self.prefetcher.clear()
+        self.listbox.delete(0, tk.END)
+        for n, item in enumerate(self.stack.fn):
+            self.listbox.insert(tk.END, "{:04d} - {}".format(n, os.path.basename(item)))
+        self.listbox.selection_set(0)
+        self.stack.current = 0
+        self.showImage(0)
+        self.updateTitle()
 
     def showImage(self, imgNr=-1):
-        if not self.windowRunning:
+        if not self.windowRunning or self.stack is None:
             return
-        current = self.stack.current
         if imgNr >= 0:
-            current = imgNr
-        img = self.stack.getImage(current)
-        if (self.stack.imageWidth > self.winSize[0]) or (
-            self.stack.imageHeight > self.winSize[1]
-        ):
-            rescaleFactorX = self.winSize[0] / self.stack.imageWidth
-            rescaleFactorY = self.winSize[1] / self.stack.imageHeight
-            rescaleFactor = min(rescaleFactorX, rescaleFactorY)
-            img = rescale(img, rescaleFactor, preserve_range=True)
-        p2, p98 = np.percentile(img, (2, 98))
-        img_rescale_int = exposure.rescale_intensity(
-            img, in_range=(p2, p98), out_range=(0, 255)
-        )
-        intensityFixedImg = PIL.Image.fromarray(img_rescale_int)
-        self.photo = PIL.ImageTk.PhotoImage(intensityFixedImg, master=self.root)
+            # _swapImage only shows the frame that is current
+            self.stack.current = min(imgNr, self.stack.nImages - 1)
+        current = self.stack.current
+        self.prefetcher.request(current, self.stack.nImages)
+        self._swapImage(current)
+
+    def _swapImage(self, current):
+        if current != self.stack.current:
+            return  # already moved on to another frame
+        img = self.prefetcher.get(current)
+        if img is None:
+            self.root.after(5, self._swapImage, current)
+            return
+        import PIL.ImageTk
+
+        self.photo = PIL.ImageTk.PhotoImage(img, master=self.root)
         self.imageCanvas.itemconfig(self.imageOnCanvas, image=self.photo)
 
+    def showNext(self, step=1):
+        import tkinter as tk
+
+        if self.stack is None:
+            return
+        pos = min(max(self.stack.current + step, 0), self.stack.nImages - 1)
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(pos)
+        self.listbox.see(pos)
+        self.stack.current = pos
+        self.showImage()
+        self.updateTitle()
+
+    def showPrevious(self):
+        self.showNext(-1)
+
     def selectList(self, evt):
         w = evt.widget
         index = int(w.curselection()[0])
@@ -286,20 +432,22 @@ class elmitecImageViewer:
         )
 
     def openImageList(self):
+        from tkinter import filedialog
+
         filenames = list(
-            tk.filedialog.askopenfilenames(
+            filedialog.askopenfilenames(
                 title="Select files",
                 filetypes=(("uView", "*.dat"), ("Tiff files", "*.tif")),
             )
         )
-        print(type(filenames))
-        self.stack = imgStackClass(filenames)
-        self.listbox.delete(0, tk.END)
-        for n, item in enumerate(self.stack.fn):
-            self.listbox.insert(tk.END, "{:04d} - {}".format(n, os.path.basename(item)))
-        self.listbox.selection_set(0)
-        self.showImage(0)
+        if filenames:
+            self.setStack(imgStackClass(filenames))
+
+
+def main(mypath=DEFAULT_DATA_DIR):
+    """Loads the .dat files of mypath and opens the viewer on them"""
+    elmitecImageViewer(imgStackClass(getDatFilesInDir(mypath)))
 
 
-imgViewer = elmitecImageViewer(stack)
-imgViewer.showImage()
+if __name__ == "__main__":
+    main(*sys.argv[1:])
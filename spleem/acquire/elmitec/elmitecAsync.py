@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterparts of oLeem and oUview.
+
+Every command is a coroutine. Each connection keeps a queue of the requests
+sent so far and a single reader task that answers them in order, so a script
+can overlap microscope control, image download and parameter polling in one
+event loop:
+
+    async def main():
+        async with asyncLeem(ip) as leem, asyncUview(ip) as uview:
+            img, _ = await asyncio.gather(uview.getImage(), leem.setValue("FL", 2960))
+"""
+
+import asyncio
+import numpy as np
+
+from .elmitecConnect import (
+    IMAGE_HEADER_SIZE,
+    SettlePolicy,
+    decodeMessage,
+    is_number,
+    moduleTableCommands,
+    parseFoV,
+    parseImageHeader,
+    parseMarker,
+    parseMarkerList,
+    parseModifiedModules,
+    parseModuleTable,
+)
+
+
+async def readMessage(reader):
+    data = await reader.readuntil(b"\0")
+    return decodeMessage(data[:-1])
+
+
+async def readImage(reader):
+    size = parseImageHeader(await reader.readexactly(IMAGE_HEADER_SIZE))
+    if size is None:
+        raise ValueError("Wrong image header")
+    xs, ys = size
+    data = await reader.readexactly(xs * ys * 2)
+    await reader.readexactly(1)
+    # the camera sends ys rows of xs pixels, img[:, i] holds row i
+    return np.frombuffer(data, dtype="<u2").reshape(ys, xs).T
+
+
+class asyncConnection:
+    """One asyncio stream to LEEM2000 or UView. Replies arrive in the order the
+    requests were written, so each request queues a future together with the
+    coroutine that parses its reply, and one reader task resolves them in turn."""
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.connected = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.disconnect()
+
+    async def connect(self):
+        if self.connected:
+            raise Exception("Already connected")
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        self.pending = asyncio.Queue()
+        self.readerTask = asyncio.create_task(self._readReplies())
+        self.connected = True
+        # Start string communication
+        await self.request("asc")
+
+    async def disconnect(self):
+        if self.connected:
+            self.connected = False
+            self.writer.write(b"clo\0")
+            self.readerTask.cancel()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _readReplies(self):
+        while True:
+            future, parse = await self.pending.get()
+            try:
+                result = await parse(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                # the stream is gone, nothing queued behind this will be answered
+                self._abort(future, ConnectionError(f"Connection lost: {e}"))
+                return
+            except Exception as e:
+                # a reply that cannot be framed (bad image header, missing NUL)
+                # leaves the stream out of step with the queue, so no later reply
+                # can be trusted either
+                self._abort(future, e)
+                return
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    def _abort(self, future, error):
+        """Closes the stream and fails future with error and every request queued
+        behind it with ConnectionError"""
+        self.connected = False
+        self.writer.close()
+        futures = [future]
+        while not self.pending.empty():
+            futures.append(self.pending.get_nowait()[0])
+        for waiting in futures:
+            if waiting.cancelled():
+                continue
+            if waiting is future:
+                waiting.set_exception(error)
+            else:
+                waiting.set_exception(ConnectionError(f"Connection closed: {error}"))
+
+    async def request(self, TCPString, parse=readMessage):
+        if not self.connected:
+            raise ConnectionError("Please connect first")
+        future = asyncio.get_running_loop().create_future()
+        # write and enqueue without yielding in between, so the queue order is the
+        # order on the wire; commands are NUL-terminated to stay separate
+        self.writer.write(TCPString.encode("utf-8") + b"\0")
+        self.pending.put_nowait((future, parse))
+        await self.writer.drain()
+        return await future
+
+    async def requestMany(self, TCPStrings):
+        return await asyncio.gather(*(self.request(cmd) for cmd in TCPStrings))
+
+
+class asyncLeem(asyncConnection):
+    def __init__(self, ip="192.168.178.26", port=5566):
+        super().__init__(ip, port)
+        self.settle = SettlePolicy()
+
+    async def connect(self):
+        await super().connect()
+        await self.updateModules()
+        await self.updateValues()
+
+    async def updateModules(self):
+        self.nModules = int(await self.request("nrm"))
+        replies = await self.requestMany(moduleTableCommands(self.nModules))
+        self.Modules, self.Mnemonic, self.lowLimit, self.highLimit = parseModuleTable(
+            self.nModules, replies
+        )
+        self.invModules = {name.upper(): x for x, name in self.Modules.items()}
+        self.invMnemonic = {mne.upper(): x for x, mne in self.Mnemonic.items()}
+
+    async def updateValues(self):
+        modules = list(self.Mnemonic)
+        replies = await self.requestMany([f"get {self.Modules[x]}" for x in modules])
+        # None marks a module that did not report a value, not a reading
+        self.Values = {
+            x: float(data) if is_number(data) else None
+            for x, data in zip(modules, replies)
+        }
+        return self
+
+    def moduleNumber(self, module):
+        if is_number(module):
+            return int(module)
+        module = str(module).upper()
+        if module in self.invModules:
+            return self.invModules[module]
+        return self.invMnemonic.get(module)
+
+    async def get(self, TCPString, module):
+        m = self.moduleNumber(module)
+        if m is None:
+            return f"Module {module} not found"
+        data = await self.request(f"{TCPString.strip()} {m}")
+        if not data in ["", "invalid"] and is_number(data):
+            return float(data)
+        return "invalid"
+
+    async def getValue(self, module):
+        m = self.moduleNumber(module)
+        remaining = self.settle.remaining(m)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+            self.settle.waited += remaining
+            self.settle.nWaits += 1
+        return await self.get("get", module)
+
+    async def setValue(self, module, value):
+        if not is_number(value):
+            return "Value must be a number"
+        m = self.moduleNumber(module)
+        if m is None:
+            return False
+        ok = await self.request(f"set {m}={value}")
+        self.settle.recordSet(m)
+        return ok == "0"
+
+    async def getLowLimit(self, module):
+        return await self.get("psl", module)
+
+    async def getHighLimit(self, module):
+        return await self.get("psh", module)
+
+    async def getFoV(self):
+        return parseFoV(await self.request("prl"))
+
+    async def getModifiedModules(self):
+        return parseModifiedModules(await self.request("chm"), self.Modules)
+
+
+class asyncUview(asyncConnection):
+    def __init__(self, ip="172.23.106.79", port=5570):
+        super().__init__(ip, port)
+
+    async def getImage(self):
+        return await self.request("ida 0 0", parse=readImage)
+
+    async def exportImage(self, fileName, imgFormat="0", imgContents="0"):
+        data = await self.request(f"exp {imgFormat}, {imgContents}, {fileName}")
+        return len(data) == 0
+
+    async def setAvr(self, avr="0"):
+        if not is_number(avr) or not (0 <= int(avr) <= 99):
+            return
+        return await self.request(f"avr {int(avr)}")
+
+    async def getAvr(self):
+        data = await self.request("avr")
+        return int(data) if is_number(data) else 0
+
+    async def acquireSingleImg(self, id=-1):
+        return await self.request(f"asi {id}")
+
+    async def aip(self):
+        return await self.request("aip") == "1"
+
+    async def getROI(self):
+        xmi, xma, ymi, yma = (
+            int(float(data)) if is_number(data) else 0
+            for data in await self.requestMany(["xmi", "xma", "ymi", "yma"])
+        )
+        return [xmi, ymi, xma, yma]
+
+    async def getMarkers(self):
+        markers = parseMarkerList(await self.request("mar -1"))
+        replies = await self.requestMany([f"mar {m}" for m in markers])
+        return {m: parseMarker(m, data) for m, data in zip(markers, replies)}
+
+    async def getCameraSize(self):
+        spl = (await self.request("gcs")).split()
+        if len(spl) == 2 and is_number(spl[0]) and is_number(spl[1]):
+            return [int(spl[0]), int(spl[1])]
+        print("Uview image size format error")
+        return [-1, -1]
+
+    async def getExposureTime(self):
+        data = await self.request("ext")
+        return float(data) if is_number(data) else 0.0
+
+    async def setExposureTime(self, ext):
+        return await self.request(f"ext {ext}")
@@ -25,11 +25,39 @@ SOFTWARE.
 edited by Jacob Gobbo
 """
 
+import json
 import socket
+import threading
 import time
+import weakref
 import numpy as np
-import struct
-import sys
+from pathlib import Path
+
+MODULE_TABLE_COMMANDS = ("nam", "mne", "psl", "psh")
+# module table replies of modules that are absent or switched off
+INVALID_REPLIES = ("", "no name", "invalid", "disabled")
+# length of the header preceding the pixel data of an ida reply
+IMAGE_HEADER_SIZE = 19
+MARKER_TYPES = {
+    0: "line",
+    1: "horizline",
+    2: "vertline",
+    5: "circle",
+    9: "text",
+    10: "cross",
+}
+
+
+class ElmitecError(Exception):
+    """Base class of the errors raised by the LEEM2000/UView clients"""
+
+
+class NotConnectedError(ElmitecError):
+    """A command was issued on a client that is not connected"""
+
+
+class ConnectionLostError(ElmitecError, ConnectionError):
+    """The socket failed or was closed while a command was in progress"""
 
 
 def is_number(s):
@@ -42,8 +70,13 @@ def is_number(s):
 
 
 def getTcp(s, TCPString, isFlt=True, isInt=False, asIs=False):
-    s.send(TCPString.encode("utf-8"))
-    retStr = TCPBlockingReceive(s)
+    reader = getReader(s)
+    try:
+        with reader.lock:
+            s.sendall(TCPString.encode("utf-8"))
+            retStr = reader.readMessage()
+    except OSError as e:
+        raise ConnectionLostError(f"{TCPString!r} failed: {e}") from e
     if asIs:
         # print('is asIs = ', TCPString, retStr)
         return retStr
@@ -62,23 +95,217 @@ def getTcp(s, TCPString, isFlt=True, isInt=False, asIs=False):
 
 
 def setTcp(s, TCPString, Value):
-    TCPString = TCPString.strip() + " " + Value.strip()
-    s.send(TCPString)
-    return TCPBlockingReceive(s)
+    TCPString = TCPString.strip() + " " + str(Value).strip()
+    return getTcp(s, TCPString, False, False, True)
+
+
+def queryTcp(s, TCPStrings, window=256):
+    """Sends the commands back to back and returns their replies in order. Each
+    command is NUL-terminated so it stays separate when several arrive in one
+    packet; at most window commands are in flight at once."""
+    reader = getReader(s)
+    replies = []
+    try:
+        with reader.lock:
+            for start in range(0, len(TCPStrings), window):
+                batch = TCPStrings[start : start + window]
+                s.sendall(b"".join(cmd.encode("utf-8") + b"\0" for cmd in batch))
+                replies.extend(reader.readMessage() for _ in batch)
+    except OSError as e:
+        raise ConnectionLostError(f"Batched query failed: {e}") from e
+    return replies
 
 
 def TCPBlockingReceive(s):
-    Bytereceived = "0"
-    szData = ""
-    while ord(Bytereceived) != 0:
-        ReceivedLength = 0
-        while ReceivedLength == 0:
-            Bytereceived = s.recv(1)
-            # print('Bytereceived=',Bytereceived,'ord(Bytereceived)=',ord(Bytereceived))
-            ReceivedLength = len(Bytereceived)
-        if ord(Bytereceived) != 0:
-            szData = szData + Bytereceived.decode("utf-8")
-    return szData
+    return getReader(s).readMessage()
+
+
+def TCPReceiveInto(s, buffer):
+    """Fills the whole (contiguous) buffer from the socket, however many recv calls
+    the stream is split over"""
+    return getReader(s).readInto(buffer)
+
+
+class TCPMessageReader:
+    """Buffered reader splitting the stream of one socket into NUL-terminated
+    messages. Bytes received past the end of a message are kept for the next one.
+    The lock serializes request/reply transactions on the socket."""
+
+    chunkSize = 65536
+
+    def __init__(self, s):
+        self.s = s
+        self.buffer = bytearray()
+        self.lock = threading.RLock()
+
+    def _receive(self):
+        chunk = self.s.recv(self.chunkSize)
+        if len(chunk) == 0:
+            raise ConnectionError("Connection closed by the remote end")
+        self.buffer += chunk
+
+    def readMessage(self) -> str:
+        searchFrom = 0
+        while True:
+            end = self.buffer.find(b"\0", searchFrom)
+            if end >= 0:
+                message = bytes(self.buffer[:end])
+                del self.buffer[: end + 1]
+                return decodeMessage(message)
+            searchFrom = len(self.buffer)
+            self._receive()
+
+    def readInto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        received = min(len(self.buffer), len(view))
+        view[:received] = self.buffer[:received]
+        del self.buffer[:received]
+        while received < len(view):
+            ReceivedLength = self.s.recv_into(view[received:])
+            if ReceivedLength == 0:
+                raise ConnectionError("Connection closed during transfer")
+            received += ReceivedLength
+        return buffer
+
+
+_readers = weakref.WeakKeyDictionary()
+
+
+def getReader(s) -> TCPMessageReader:
+    """Returns the message reader of the socket, creating it on first use"""
+    try:
+        return _readers[s]
+    except KeyError:
+        return _readers.setdefault(s, TCPMessageReader(s))
+
+
+def decodeMessage(message: bytes) -> str:
+    try:
+        return message.decode("utf-8")
+    except UnicodeDecodeError:
+        # LEEM2000 sends the micro sign of the FoV as a single latin-1 byte
+        return message.decode("latin-1")
+
+
+def moduleTableCommands(nModules):
+    """Commands querying name, mnemonic and limits of every module, in the order
+    parseModuleTable expects their replies"""
+    return [f"{cmd} {x}" for x in range(nModules) for cmd in MODULE_TABLE_COMMANDS]
+
+
+def parseModuleTable(nModules, replies):
+    modules, mnemonic, lowLimit, highLimit = {}, {}, {}, {}
+    invalid = INVALID_REPLIES
+    n = len(MODULE_TABLE_COMMANDS)
+    for x in range(nModules):
+        name, mne, ll, hl = replies[x * n : (x + 1) * n]
+        if not name in invalid:
+            modules[x] = name
+        if not mne in invalid:
+            mnemonic[x] = mne
+            # limits are only kept for modules with a mnemonic
+            if (not ll in invalid) and is_number(ll):
+                lowLimit[x] = float(ll)
+            if (not hl in invalid) and is_number(hl):
+                highLimit[x] = float(hl)
+    return modules, mnemonic, lowLimit, highLimit
+
+
+def parseFoV(data):
+    strSplit = data.partition(":")
+    if strSplit[1] == ":":
+        part = data.partition("\xb5")
+        if part[1] == "\xb5":
+            FoVStr = part[0]
+            if is_number(FoVStr):
+                return (float(FoVStr), True)  # True means that the FoV is a number
+    return (data, False)  # False means that no useful number is given out
+
+
+def parseModifiedModules(data, modules):
+    """Parses the reply of chm: the number of changes followed by module/value pairs"""
+    if data != "0":
+        arr = data.split()
+        nChanges = int(arr[0])
+        del arr[0]
+        Changes = []
+        for i in range(nChanges):
+            Changes.append(
+                {
+                    "moduleName": modules.get(int(arr[i * 2]), ""),
+                    "moduleNr": int(arr[i * 2]),
+                    "NewValue": float(arr[1 + i * 2]),
+                }
+            )
+        return (nChanges, Changes)
+    else:
+        return (0, 0)
+
+
+def parseMarkerList(data):
+    """Returns the marker numbers listed in a "mar -1" reply (count, then numbers)"""
+    fields = data.split()
+    if len(fields) <= 1 or not is_number(fields[0]):
+        return []
+    return [int(marker) for marker in fields[1 : int(fields[0]) + 1]]
+
+
+def parseMarker(marker, data):
+    """Parses the "mar <marker>" reply, returns 0 if it is malformed"""
+    splitMarker = data.split()
+    if len(splitMarker) != 7:
+        return 0
+    typeNr = int(splitMarker[2])
+    return {
+        "marker": marker,
+        "imgNr": int(splitMarker[1]),
+        "type": MARKER_TYPES.get(typeNr, "unknown"),
+        "typeNr": typeNr,
+        "pos": [int(x) for x in splitMarker[3:7]],
+    }
+
+
+def parseImageHeader(header):
+    """Returns the (xs, ys) size announced by the 19-byte header of an ida reply,
+    or None if the header is malformed"""
+    arr = header.split()
+    if len(arr) != 3 or not (arr[1].isdigit() and arr[2].isdigit()):
+        return None
+    return int(arr[1]), int(arr[2])
+
+
+class SettlePolicy:
+    """Rate limit of oLeem reads after a set. A read of a module waits only for
+    what remains of that module's settle time since it was last set; reads of
+    other modules pass freely. The total time spent waiting is recorded."""
+
+    def __init__(self, defaultSettle=0.3, settleTimes=None):
+        self.defaultSettle = defaultSettle
+        self.settleTimes = dict(settleTimes or {})
+        self.lastSet = {}
+        self.waited = 0.0
+        self.nWaits = 0
+
+    def settleTime(self, module):
+        return self.settleTimes.get(module, self.defaultSettle)
+
+    def recordSet(self, module):
+        self.lastSet[module] = time.monotonic()
+
+    def remaining(self, module):
+        if module not in self.lastSet:
+            return 0.0
+        return max(
+            0.0, self.lastSet[module] + self.settleTime(module) - time.monotonic()
+        )
+
+    def wait(self, module):
+        remaining = self.remaining(module)
+        if remaining > 0:
+            time.sleep(remaining)
+            self.waited += remaining
+            self.nWaits += 1
+        return remaining
 
 
 class elmitecConnect:
@@ -124,11 +351,11 @@ class elmitecConnect:
     def __exit__(self, type, value, traceback):
         # print("Destroying", self)
         try:
-            self.oLeem.disconnect
+            self.oLeem.disconnect()
         except AttributeError:
             print("oLEEM not open yet")
         try:
-            self.oUview.disconnect
+            self.oUview.disconnect()
         except AttributeError:
             print("oUview not open yet")
 
@@ -153,6 +380,10 @@ class elmitecConnect:
 
 class oLeem:
     Leem2000Connected = False
+    # module tables of known instruments, reused to skip discovery on reconnect
+    moduleCacheFile = Path.home() / ".spleem" / "leem_modules.json"
+    # socket timeout in seconds, None blocks until the reply arrives
+    timeout = None
 
     def __enter__(self):
         return self
@@ -172,7 +403,11 @@ class oLeem:
         else:
             self.port = port
 
-        self.lastTime = time.time()
+        self.settle = SettlePolicy()
+        self.subscribers = {}
+        self._cacheThread = None
+        # poll interval of the parameter cache while it is requested, else None
+        self.cacheInterval = None
 
         if directConnect:
             print(f"Connect with ip: {self.ip}, port: {self.port}")
@@ -199,6 +434,7 @@ class oLeem:
             # return
         else:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.settimeout(self.timeout)
             print("connecting leem with")
             print(self.ip)
             print(self.port)
@@ -283,53 +519,107 @@ class oLeem:
             self.Leem2000Connected = False
             print("Disconnected!")
 
+    def _dropConnection(self):
+        """Forgets a dead socket without talking to it, so connect() can open a new
+        one"""
+        if self.Leem2000Connected:
+            try:
+                self.s.close()
+            except OSError:
+                pass
+            self.Leem2000Connected = False
+
     def updateValues(self):
         if not self.Leem2000Connected:
-            raise Exception("Connect before updating values.")
+            raise NotConnectedError("Connect before updating values.")
             # print("Please connect first")
             # return None
         else:
+            modules = list(self.Mnemonic)
+            replies = queryTcp(self.s, [f"get {self.Modules[x]}" for x in modules])
             self.Values = {}
-            for x in self.Mnemonic:
-                data = getTcp(self.s, f"get {self.Modules[x]}", True, False, False)
-                if is_number(data):
-                    self.Values[x] = float(data)
+            for x, data in zip(modules, replies):
+                # None marks a module that did not report a value, not a reading
+                self.Values[x] = float(data) if is_number(data) else None
 
         return self
 
-    def updateModules(self):
+    def updateModules(self, useCache=True):
+        """Reads the module table (names, mnemonics and limits). All queries are
+        pipelined, and with useCache the table stored for this instrument is reused
+        as long as it still reports the same module names."""
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             # Get list of devices
             self.nModules = getTcp(self.s, "nrm", False, True, False)
-            # Get list of devices
-            self.Modules = {}
-            self.Mnemonic = {}
-            self.invModules = {}
-            self.invMnemonic = {}
-            self.lowLimit = {}
-            self.highLimit = {}
-            self.MnemonicUp = {}
-            self.ModulesUp = {}
-            for x in range(self.nModules):
-                data = getTcp(self.s, "nam " + str(x), False, False, True)
-                if not data in ["", "no name", "invalid", "disabled"]:
-                    self.Modules[x] = data
-                    self.ModulesUp[x] = data.upper()
-                    self.invModules[data.upper()] = x
-                data = getTcp(self.s, "mne " + str(x), False, False, True)
-                if not data in ["", "no name", "invalid", "disabled"]:
-                    self.Mnemonic[x] = data
-                    self.MnemonicUp[x] = data.upper()
-                    self.invMnemonic[data.upper()] = x
-                ll = self.getLowLimit(x, isNotSetup=False)
-                hl = self.getHighLimit(x, isNotSetup=False)
-                if (not ll in ["", "no name", "invalid", "disabled"]) and is_number(ll):
-                    self.lowLimit[x] = ll
-                if (not hl in ["", "no name", "invalid", "disabled"]) and is_number(hl):
-                    self.highLimit[x] = hl
+            cache = self._loadModuleCache() if useCache else None
+            if cache is not None and self._moduleCacheValid(cache):
+                self._setModuleTable(
+                    cache["Modules"],
+                    cache["Mnemonic"],
+                    cache["lowLimit"],
+                    cache["highLimit"],
+                )
+                return
+
+            replies = queryTcp(self.s, moduleTableCommands(self.nModules))
+            modules, mnemonic, lowLimit, highLimit = parseModuleTable(
+                self.nModules, replies
+            )
+            self._setModuleTable(modules, mnemonic, lowLimit, highLimit)
+            self._saveModuleCache()
+
+    def _setModuleTable(self, modules, mnemonic, lowLimit, highLimit):
+        self.Modules = {int(x): name for x, name in modules.items()}
+        self.Mnemonic = {int(x): mne for x, mne in mnemonic.items()}
+        self.lowLimit = {int(x): ll for x, ll in lowLimit.items()}
+        self.highLimit = {int(x): hl for x, hl in highLimit.items()}
+        self.ModulesUp = {x: name.upper() for x, name in self.Modules.items()}
+        self.MnemonicUp = {x: mne.upper() for x, mne in self.Mnemonic.items()}
+        self.invModules = {name: x for x, name in self.ModulesUp.items()}
+        self.invMnemonic = {mne: x for x, mne in self.MnemonicUp.items()}
+
+    def _moduleCacheValid(self, cache):
+        """Checks a cached table against the module names the instrument reports
+        now, with one pipelined nam per module instead of the full table"""
+        if cache["nModules"] != self.nModules:
+            return False
+        names = queryTcp(self.s, [f"nam {x}" for x in range(self.nModules)])
+        modules = {
+            x: name for x, name in enumerate(names) if name not in INVALID_REPLIES
+        }
+        return modules == {int(x): name for x, name in cache["Modules"].items()}
+
+    def _moduleCacheKey(self):
+        return f"{self.ip}:{self.port}"
+
+    def _loadModuleCache(self):
+        try:
+            with open(self.moduleCacheFile, "r") as f:
+                return json.load(f).get(self._moduleCacheKey())
+        except (OSError, ValueError):
+            return None
+
+    def _saveModuleCache(self):
+        try:
+            with open(self.moduleCacheFile, "r") as f:
+                caches = json.load(f)
+        except (OSError, ValueError):
+            caches = {}
+        caches[self._moduleCacheKey()] = {
+            "nModules": self.nModules,
+            "Modules": self.Modules,
+            "Mnemonic": self.Mnemonic,
+            "lowLimit": self.lowLimit,
+            "highLimit": self.highLimit,
+        }
+        try:
+            self.moduleCacheFile.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.moduleCacheFile, "w") as f:
+                json.dump(caches, f)
+        except OSError:
+            print("Could not write module cache to " + str(self.moduleCacheFile))
 
     def get(self, TCPString, module):
         # check if the input is a number or a string
@@ -351,7 +641,7 @@ class oLeem:
             if module.upper() in self.invModules:
                 data = getTcp(
                     self.s,
-                    TCPString + (self.invModules[module.upper()]),
+                    TCPString + str(self.invModules[module.upper()]),
                     False,
                     False,
                     True,
@@ -377,18 +667,15 @@ class oLeem:
 
     def getValue(self, module):
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
-            # check if the input is a number or a string
-            if (time.time() - self.lastTime) < 0.3:
-                time.sleep(0.3)
+            # only wait for what is left of the settle time of this very module
+            self.settle.wait(self.moduleNumber(module))
             return self.get("get ", module)
 
     def setValue(self, module, value):
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             # check if the input value is a number or a string
             if not is_number(value):
@@ -396,99 +683,142 @@ class oLeem:
             else:
                 value = str(value)
             # check if the input module is a number or a string
-            self.lastTime = time.time()
             if is_number(module):
                 m = int(module)
-                return (
-                    getTcp(self.s, "set " + str(m) + "=" + value, False, False, True)
-                    == "0"
-                )
+                ok = getTcp(self.s, "set " + str(m) + "=" + value, False, False, True)
             else:
                 if (module.upper() in self.MnemonicUp.values()) or (
                     module.upper() in self.ModulesUp.values()
                 ):
-                    return (
-                        getTcp(
-                            self.s,
-                            "set " + str(module) + "=" + value,
-                            False,
-                            False,
-                            True,
-                        )
-                        == "0"
+                    ok = getTcp(
+                        self.s,
+                        "set " + str(module) + "=" + value,
+                        False,
+                        False,
+                        True,
                     )
                 else:
                     return False
+            self.settle.recordSet(self.moduleNumber(module))
+            return ok == "0"
+
+    def moduleNumber(self, module):
+        """Returns the number of a module given by number, name or mnemonic, or None
+        if the module is unknown"""
+        if is_number(module):
+            return int(module)
+        module = str(module).upper()
+        if module in self.invModules:
+            return self.invModules[module]
+        return self.invMnemonic.get(module)
+
+    def setSettleTime(self, module, settleTime):
+        """Sets how long reads of a module wait after it was set, in seconds"""
+        self.settle.settleTimes[self.moduleNumber(module)] = settleTime
+        return self
 
     def getLowLimit(self, module, isNotSetup=True):
+        # limits do not change when a value is set, so there is no settle wait
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
-
-            if (time.time() - self.lastTime) < 0.3 and isNotSetup:
-                time.sleep(0.3)
-            self.lastTime = time.time()
             TCPString = "psl "
             return self.get(TCPString, module)
 
     def getHighLimit(self, module, isNotSetup=True):
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
-            if (time.time() - self.lastTime) < 0.3 and isNotSetup:
-                time.sleep(0.3)
-            self.lastTime = time.time()
             TCPString = "psh "
             return self.get(TCPString, module)
 
     def getFoV(self):
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             # check if the input is a number or a string
             data = getTcp(self.s, "prl", False, False, True)
-            strSplit = data.partition(":")
-            if strSplit[1] == ":":
-                part = data.partition("\xb5")
-                if part[1] == "\xb5":
-                    FoVStr = part[0]
-                    if is_number(FoVStr):
-                        return (
-                            float(FoVStr),
-                            True,
-                        )  # True means that the FoV is a number
-            return (data, False)  # False means that no useful number is given out
+            return parseFoV(data)
 
     def getModifiedModules(self):
         if not self.Leem2000Connected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             # check if the input is a number or a string
             data = getTcp(self.s, "chm", False, False, True)
-            if data != "0":
-                arr = data.split()
-                nChanges = int(arr[0])
-                del arr[0]
-                Changes = []
-                for i in range(nChanges):
-                    Changes.append(
-                        {
-                            "moduleName": self.Modules[int(arr[i * 2])],
-                            "moduleNr": int(arr[i * 2]),
-                            "NewValue": float(arr[1 + i * 2]),
-                        }
-                    )
-                return (nChanges, Changes)
-            else:
-                return (0, 0)
+            return parseModifiedModules(data, self.Modules)
+
+    def startParameterCache(self, interval=0.2):
+        """Fills Values once and keeps it current from a background thread that polls
+        chm, so cachedValue never touches the socket. Subscribers are called from
+        that thread for every change."""
+        if self._cacheThread is not None and self._cacheThread.is_alive():
+            return self
+        # drop the changes accumulated so far, the full refresh covers them
+        self.getModifiedModules()
+        self.updateValues()
+        self._cacheStop = threading.Event()
+        self._cacheThread = threading.Thread(
+            target=self._pollChanges, args=(interval,), daemon=True
+        )
+        self._cacheThread.start()
+        self.cacheInterval = interval
+        return self
+
+    def stopParameterCache(self):
+        if self._cacheThread is not None:
+            self._cacheStop.set()
+            self._cacheThread.join()
+            self._cacheThread = None
+        self.cacheInterval = None
+
+    def _pollChanges(self, interval):
+        while not self._cacheStop.wait(interval):
+            try:
+                nChanges, changes = self.getModifiedModules()
+            except (OSError, ElmitecError):
+                print("Parameter cache stopped: connection lost")
+                return
+            for i in range(nChanges):
+                x = changes[i]["moduleNr"]
+                value = changes[i]["NewValue"]
+                self.Values[x] = value
+                callbacks = self.subscribers.get(x, []) + self.subscribers.get(None, [])
+                for callback in callbacks:
+                    # a failing subscriber must not stop the cache for everyone
+                    try:
+                        callback(x, value)
+                    except Exception as e:
+                        print(f"Parameter cache subscriber {callback!r} failed: {e}")
+
+    def subscribe(self, callback, module=None):
+        """Calls callback(moduleNr, value) whenever the module changes, or whenever
+        any module changes if module is None"""
+        key = None if module is None else self.moduleNumber(module)
+        self.subscribers.setdefault(key, []).append(callback)
+        return callback
+
+    def unsubscribe(self, callback, module=None):
+        key = None if module is None else self.moduleNumber(module)
+        self.subscribers.get(key, []).remove(callback)
+
+    def snapshot(self):
+        """Returns module name -> value for every module, from the parameter cache
+        when it is running and from one pipelined refresh otherwise. Modules that
+        did not report a value map to None."""
+        if self._cacheThread is None or not self._cacheThread.is_alive():
+            self.updateValues()
+        return {self.Modules.get(x, str(x)): value for x, value in self.Values.items()}
+
+    def cachedValue(self, module):
+        """Returns the last known value of a module without any socket traffic"""
+        return self.Values.get(self.moduleNumber(module))
 
 
 class oUview(object):
     UviewConnected = False
+    # socket timeout in seconds, None blocks until the reply arrives
+    timeout = None
 
     def __enter__(self):
         return self
@@ -507,6 +837,9 @@ class oUview(object):
             self.port = port
 
         self.lastTime = time.time()
+        # last results of getROI and getMarkers
+        self.roi = None
+        self.markers = None
 
         if directConnect:
             print("Connect with ip=" + str(self.ip) + ", port=" + str(self.port))
@@ -526,12 +859,12 @@ class oUview(object):
             return None
         else:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.settimeout(self.timeout)
             self.s.connect((self.ip, self.port))
             self.UviewConnected = True
             # Start string communication
             TCPString = "asc"
-            self.s.send(TCPString.encode("utf-8"))
-            data = TCPBlockingReceive(self.s)
+            data = getTcp(self.s, TCPString, False, False, True)
 
     def testConnect(self):
         if self.UviewConnected:
@@ -587,49 +920,64 @@ class oUview(object):
             self.UviewConnected = False
             print("Disconnected!")
 
-    def getImage(self):
+    def _dropConnection(self):
+        """Forgets a dead socket without talking to it, so connect() can open a new
+        one"""
+        if self.UviewConnected:
+            try:
+                self.s.close()
+            except OSError:
+                pass
+            self.UviewConnected = False
+
+    def getImage(self, out=None):
+        """Returns the current image. If out is given, it must be a C-contiguous
+        (ys, xs) uint16 array; the pixels are received directly into it and an
+        ElmitecError is raised if the image UView sends has another size."""
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             TCPString = "ida 0 0"
-            self.s.send(TCPString.encode("utf-8"))
-            header = "".encode("utf-8")
-            for i in range(19):
-                header += self.s.recv(1)
-            print(header)
-            arr = header.split()
-            if len(arr) != 3:
-                print("Wrong header. Exit")
-                return
-            xs = int(arr[1])
-            ys = int(arr[2])
-            img = np.zeros((xs, ys), dtype=np.uint16)  # must be 16 bit
-            if sys.version_info >= (2, 7):
-                for i in range(ys):
-                    img[:, i] = struct.unpack("{}H".format(xs), self.s.recv(xs * 2))
-            else:
-                for i in range(ys):
-                    img[:, i] = struct.unpack("{0}H".format(xs), self.s.recv(xs * 2))
-            void = self.s.recv(1)
-            return img
+            reader = getReader(self.s)
+            try:
+                with reader.lock:
+                    self.s.sendall(TCPString.encode("utf-8"))
+                    header = reader.readInto(bytearray(IMAGE_HEADER_SIZE))
+                    size = parseImageHeader(header)
+                    if size is None:
+                        raise ElmitecError(f"Wrong image header {bytes(header)!r}")
+                    xs, ys = size
+                    # the camera sends ys rows of xs pixels, img[:, i] holds row i
+                    if out is not None and out.shape == (ys, xs):
+                        data = out
+                    else:
+                        data = np.empty((ys, xs), dtype="<u2")  # must be 16 bit
+                    # receive the whole reply even if it does not fit out, so the
+                    # next command is not answered with leftover pixels
+                    reader.readInto(data)
+                    void = reader.readInto(bytearray(1))
+            except OSError as e:
+                raise ConnectionLostError(f"Image transfer failed: {e}") from e
+            if out is not None and data is not out:
+                raise ElmitecError(
+                    f"Received a {(ys, xs)} image, which does not fit out of shape "
+                    f"{out.shape}"
+                )
+            return data.T
 
     def exportImage(self, fileName, imgFormat="0", imgContents="0"):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             TCPString = (
                 "exp " + str(imgFormat) + ", " + str(imgContents) + ", " + str(fileName)
             )
-            self.s.send(TCPString.encode("utf-8"))
-            data = TCPBlockingReceive(self.s)
+            data = getTcp(self.s, TCPString, False, False, True)
             return len(data) == 0
 
     def setAvr(self, avr="0"):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             if not is_number(avr):
                 return
@@ -640,12 +988,10 @@ class oUview(object):
 
     def getAvr(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             TCPString = "avr"
-            self.s.send(TCPString.encode("utf-8"))
-            data = TCPBlockingReceive(self.s)
+            data = getTcp(self.s, TCPString, False, False, True)
             if is_number(data):
                 return int(data)
             else:
@@ -653,17 +999,14 @@ class oUview(object):
 
     def acquireSingleImg(self, id=-1):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             TCPString = "asi " + str(id)
-            self.s.send(TCPString.encode("utf-8"))
-            return TCPBlockingReceive(self.s)
+            return getTcp(self.s, TCPString, False, False, True)
 
     def setAcqState(self, acqState=-1):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             if (acqState == -1) or (acqState == "-1"):
                 acqState = self.aip()
@@ -671,36 +1014,32 @@ class oUview(object):
             if (acqState != "0") or (acqState != "1"):
                 return
             TCPString = "aip " + str(acqState)
-            self.s.send(TCPString.encode("utf-8"))
-            return TCPBlockingReceive(self.s)
+            return getTcp(self.s, TCPString, False, False, True)
 
     def getAcqState(self):
         return self.aip()
 
     def aip(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             TCPString = "aip"
-            self.s.send(TCPString.encode("utf-8"))
-            return TCPBlockingReceive(self.s) == "1"
+            return getTcp(self.s, TCPString, False, False, True) == "1"
 
     def getROI(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
-            xmi = getTcp(self.s, "xmi", False, True)
-            xma = getTcp(self.s, "xma", False, True)
-            ymi = getTcp(self.s, "ymi", False, True)
-            yma = getTcp(self.s, "yma", False, True)
-            return [xmi, ymi, xma, yma]
+            xmi, xma, ymi, yma = (
+                int(float(data)) if is_number(data) else 0
+                for data in queryTcp(self.s, ["xmi", "xma", "ymi", "yma"])
+            )
+            self.roi = [xmi, ymi, xma, yma]
+            return self.roi
 
     def getCameraSize(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             gcs = getTcp(self.s, "gcs", False, False, True)
             spl = gcs.split()
@@ -716,79 +1055,206 @@ class oUview(object):
 
     def getExposureTime(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             ext = getTcp(self.s, "ext", True, False, False)
             return ext
 
     def setExposureTime(self, ext):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             setTcp(self.s, "ext", ext)
             return
 
     def getNrActiveMarkers(self):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
-            print("call nMarkersStr")
-            nMarkersStr = getTcp(self.s, "mar -1", False, False, True)
-            print("nMarkersStr returns = ", nMarkersStr)
-            nMarkers = nMarkersStr.split()
-            if len(nMarkers) <= 1:
-                return 0
-            if not is_number(nMarkers[0]):
+            markers = parseMarkerList(getTcp(self.s, "mar -1", False, False, True))
+            if len(markers) == 0:
                 return 0
-            nm = int(nMarkers[0])
-            del nMarkers[0]
-            markers = []
-            for i in nMarkers:
-                markers.append(int(i))
-            return [nm, markers]
+            return [len(markers), markers]
 
     def getMarkerInfo(self, marker):
         if not self.UviewConnected:
-            print("Please connect first")
-            return None
+            raise NotConnectedError("Please connect first")
         else:
             if not is_number(marker):
                 print("Marker value must be a valid number")
                 return
-            markerInfo = setTcp(self.s, "mar", str(marker))
-            splitMarker = markerInfo.split()
-            if len(splitMarker) != 7:
-                return 0
-            typeNr = int(splitMarker[2])
-            if typeNr == 0:
-                myType = "line"
-            elif typeNr == 1:
-                myType = "horizline"
-            elif typeNr == 2:
-                myType = "vertline"
-            elif typeNr == 5:
-                myType = "circle"
-            elif typeNr == 9:
-                myType = "text"
-            elif typeNr == 10:
-                myType = "cross"
-            else:
-                myType = "unknown"
-            return {
-                "marker": marker,
-                "imgNr": int(splitMarker[1]),
-                "type": myType,
-                "typeNr": typeNr,
-                "pos": [
-                    int(splitMarker[3]),
-                    int(splitMarker[4]),
-                    int(splitMarker[5]),
-                    int(splitMarker[6]),
-                ],
-            }
+            return parseMarker(marker, setTcp(self.s, "mar", str(marker)))
+
+    def getMarkers(self, refresh=False):
+        """Returns marker number -> getMarkerInfo dict for all active markers. Only
+        the marker list is queried on each call; the descriptors are fetched in one
+        pipelined burst when the list has changed since the last call, or with
+        refresh=True."""
+        if not self.UviewConnected:
+            raise NotConnectedError("Please connect first")
+        else:
+            markers = parseMarkerList(getTcp(self.s, "mar -1", False, False, True))
+            if refresh or self.markers is None or list(self.markers) != markers:
+                replies = queryTcp(self.s, [f"mar {m}" for m in markers])
+                self.markers = {
+                    m: parseMarker(m, data) for m, data in zip(markers, replies)
+                }
+            return self.markers
+
+
+class connectionManager:
+    """Keeps an oLeem or oUview connected through unattended runs.
+
+    Every call made through the manager is retried once after a reconnect if the
+    connection turns out to be lost. Reconnecting backs off exponentially up to
+    maxBackoff seconds, reloads the module table (from the module cache), restarts
+    a requested parameter cache and replays the setup calls registered with
+    addSetup. After maxAttempts failed attempts ConnectionLostError is raised.
+    With startKeepAlive the connection is checked every interval seconds with a
+    cheap command (nrm for LEEM2000, aip for UView).
+
+        uview = connectionManager(oUview(ip)).startKeepAlive()
+        uview.addSetup("setExposureTime", 200)
+        img = uview.getImage()
+    """
+
+    def __init__(
+        self,
+        client,
+        healthCommand=None,
+        interval=5.0,
+        timeout=10.0,
+        backoff=0.5,
+        maxBackoff=30.0,
+        maxAttempts=None,
+    ):
+        self.client = client
+        if healthCommand is None:
+            healthCommand = "nrm" if isinstance(client, oLeem) else "aip"
+        self.healthCommand = healthCommand
+        self.interval = interval
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.maxAttempts = maxAttempts
+        self.setup = []
+        self.reconnects = 0
+        self.lock = threading.RLock()
+        self._keepAliveThread = None
+        client.timeout = timeout
+        if self.connected:
+            client.s.settimeout(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopKeepAlive()
+        self.client.disconnect()
+
+    def __getattr__(self, name):
+        # only called for attributes the manager does not have itself
+        if name == "client":
+            raise AttributeError(name)
+        attr = getattr(self.client, name)
+        if callable(attr):
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        return attr
+
+    @property
+    def connected(self):
+        if isinstance(self.client, oLeem):
+            return self.client.Leem2000Connected
+        return self.client.UviewConnected
+
+    def addSetup(self, method, *args, **kwargs):
+        """Registers a client call (method name or callable) that is replayed after
+        every reconnect, e.g. exposure time or averaging; it should be idempotent"""
+        self.setup.append((method, args, kwargs))
+        return self
+
+    def _method(self, method):
+        return getattr(self.client, method) if isinstance(method, str) else method
+
+    def healthCheck(self):
+        """Returns True if the instrument answers the health command"""
+        if not self.connected:
+            return False
+        try:
+            getTcp(self.client.s, self.healthCommand, False, False, True)
+            return True
+        except (OSError, ElmitecError):
+            return False
+
+    def reconnect(self):
+        """Replaces the socket of the client by a new connection and restores its
+        state. Blocks until connected, or raises ConnectionLostError after
+        maxAttempts failed attempts."""
+        with self.lock:
+            cacheInterval = getattr(self.client, "cacheInterval", None)
+            if cacheInterval is not None:
+                self.client.stopParameterCache()
+            delay = self.backoff
+            attempt = 0
+            while True:
+                self.client._dropConnection()
+                attempt += 1
+                try:
+                    self.client.connect()
+                    break
+                except (OSError, ElmitecError) as e:
+                    if self.maxAttempts is not None and attempt >= self.maxAttempts:
+                        raise ConnectionLostError(
+                            f"Reconnect to {self.client.ip}:{self.client.port} "
+                            f"failed after {attempt} attempts: {e}"
+                        ) from e
+                    print(f"Reconnect failed ({e}), retrying in {delay:.1f} s")
+                    time.sleep(delay)
+                    delay = min(2 * delay, self.maxBackoff)
+            for method, args, kwargs in self.setup:
+                self._method(method)(*args, **kwargs)
+            if cacheInterval is not None:
+                self.client.startParameterCache(cacheInterval)
+            self.reconnects += 1
+            print(f"Reconnected to {self.client.ip}:{self.client.port}")
+        return self
+
+    def call(self, method, *args, **kwargs):
+        """Calls a client method (name or callable), reconnecting and retrying once
+        if the connection is lost"""
+        reconnects = self.reconnects
+        try:
+            return self._method(method)(*args, **kwargs)
+        except (ConnectionLostError, NotConnectedError):
+            with self.lock:
+                # another thread may have reconnected in the meantime
+                if self.reconnects == reconnects:
+                    self.reconnect()
+            return self._method(method)(*args, **kwargs)
+
+    def startKeepAlive(self):
+        if self._keepAliveThread is not None and self._keepAliveThread.is_alive():
+            return self
+        self._keepAliveStop = threading.Event()
+        self._keepAliveThread = threading.Thread(target=self._keepAlive, daemon=True)
+        self._keepAliveThread.start()
+        return self
+
+    def stopKeepAlive(self):
+        if self._keepAliveThread is not None:
+            self._keepAliveStop.set()
+            self._keepAliveThread.join()
+            self._keepAliveThread = None
+
+    def _keepAlive(self):
+        while not self._keepAliveStop.wait(self.interval):
+            if self.healthCheck():
+                continue
+            print("Connection lost, reconnecting")
+            try:
+                self.reconnect()
+            except ElmitecError as e:
+                print(f"Keep-alive stopped: {e}")
+                return
 
 
 """
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar log of the oLeem module values during a run.
+
+parameterLogger records every module change reported by chm (through the oLeem
+parameter cache) as one (time, module, value) row. The rows are buffered and
+appended in batches to three raw little-endian column files:
+
+    time.f8      unix time in seconds, float64
+    module.i4    module number, int32
+    value.f8     new value, float64
+
+plus modules.json mapping the module numbers to their names. parameterLog reads
+a log back and answers time queries with vectorized searchsorted, e.g. the
+instrument state at the imageTime of every frame:
+
+    log = parameterLog(folder)
+    fl = log.valuesAt(filetimeToUnix(times), ["Field Lens"])["Field Lens"]
+"""
+
+import json
+import os
+import threading
+import time
+import numpy as np
+
+COLUMNS = {"time": "<f8", "module": "<i4", "value": "<f8"}
+# seconds between 1601-01-01 (FILETIME epoch) and 1970-01-01
+FILETIME_EPOCH_OFFSET = 11644473600
+
+
+def filetimeToUnix(filetime):
+    """Converts Windows FILETIME values (100 ns ticks since 1601), like the
+    imageTime of a UView .dat file, to unix time in seconds"""
+    return np.asarray(filetime, dtype=np.float64) / 1e7 - FILETIME_EPOCH_OFFSET
+
+
+def _columnPath(folder, column):
+    return os.path.join(folder, f"{column}.{COLUMNS[column][1:]}")
+
+
+class parameterLogger:
+    """Logs the module values of leem (an oLeem) into folder from the moment
+    start is called. The rows are flushed every flushInterval seconds, or as soon
+    as bufferSize rows are waiting."""
+
+    def __init__(self, leem, folder, flushInterval=1.0, bufferSize=4096):
+        self.leem = leem
+        self.folder = folder
+        self.flushInterval = flushInterval
+        self.bufferSize = bufferSize
+        self.rowsWritten = 0
+        self.buffer = []
+        self.lock = threading.Lock()
+        # keeps the three columns of concurrent flushes in the same row order
+        self._writeLock = threading.Lock()
+        self._flushThread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self, pollInterval=0.2):
+        """Records the current value of every module and then every change"""
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, "modules.json"), "w") as f:
+            json.dump({str(x): name for x, name in self.leem.Modules.items()}, f)
+
+        # leave a parameter cache that was already running to its owner
+        self._ownsCache = self.leem.cacheInterval is None
+        self.leem.startParameterCache(pollInterval)
+        now = time.time()
+        with self.lock:
+            self.buffer.extend(
+                (now, x, v) for x, v in self.leem.Values.items() if v is not None
+            )
+        self.leem.subscribe(self.record)
+
+        self._stop = threading.Event()
+        self._full = threading.Event()
+        self._flushThread = threading.Thread(target=self._flushLoop, daemon=True)
+        self._flushThread.start()
+        return self
+
+    def stop(self):
+        if self._flushThread is None:
+            return
+        self.leem.unsubscribe(self.record)
+        if self._ownsCache:
+            self.leem.stopParameterCache()
+        self._stop.set()
+        self._full.set()
+        self._flushThread.join()
+        self._flushThread = None
+        self.flush()
+
+    def record(self, module, value, t=None):
+        """Adds one row; called by the parameter cache for every change. Missing
+        values (None) are not logged."""
+        if value is None:
+            return
+        with self.lock:
+            self.buffer.append((time.time() if t is None else t, module, value))
+            if len(self.buffer) >= self.bufferSize:
+                self._full.set()
+
+    def _flushLoop(self):
+        while not self._stop.is_set():
+            self._full.wait(self.flushInterval)
+            self._full.clear()
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered rows to the column files"""
+        with self._writeLock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+            if not rows:
+                return
+            columns = zip(*rows)
+            for (column, dtype), values in zip(COLUMNS.items(), columns):
+                with open(_columnPath(self.folder, column), "ab") as f:
+                    np.asarray(values, dtype=dtype).tofile(f)
+            self.rowsWritten += len(rows)
+
+
+class parameterLog:
+    """Reads a parameterLogger folder. time, module and value are the columns,
+    ordered by time."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "modules.json")) as f:
+            self.Modules = {int(x): name for x, name in json.load(f).items()}
+        self.invModules = {name.upper(): x for x, name in self.Modules.items()}
+
+        columns = {
+            column: np.fromfile(_columnPath(folder, column), dtype=dtype)
+            for column, dtype in COLUMNS.items()
+        }
+        # a log cut off mid-flush may have columns of different length
+        n = min(len(values) for values in columns.values())
+        order = np.argsort(columns["time"][:n], kind="stable")
+        self.time = columns["time"][:n][order]
+        self.module = columns["module"][:n][order]
+        self.value = columns["value"][:n][order]
+
+    def __len__(self):
+        return len(self.time)
+
+    def moduleNumber(self, module):
+        if isinstance(module, (int, np.integer)):
+            return int(module)
+        return self.invModules[str(module).upper()]
+
+    def series(self, module):
+        """Returns the (time, value) arrays of every logged change of module"""
+        mask = self.module == self.moduleNumber(module)
+        return self.time[mask], self.value[mask]
+
+    def between(self, start, stop):
+        """Returns the (time, module, value) rows logged in [start, stop)"""
+        first, last = np.searchsorted(self.time, [start, stop])
+        return self.time[first:last], self.module[first:last], self.value[first:last]
+
+    def valuesAt(self, times, modules=None):
+        """Returns module name -> array with the value each module had at times
+        (unix seconds), NaN before its first logged value. modules defaults to
+        every logged module."""
+        times = np.asarray(times, dtype=np.float64)
+        if modules is None:
+            modules = [self.Modules.get(x, x) for x in np.unique(self.module)]
+        values = {}
+        for module in modules:
+            t, v = self.series(module)
+            if len(t) == 0:
+                values[module] = np.full(times.shape, np.nan)
+                continue
+            index = np.searchsorted(t, times, side="right") - 1
+            values[module] = np.where(index >= 0, v[np.maximum(index, 0)], np.nan)
+        return values
+
+    def stateAt(self, t):
+        """Returns module name -> value of every module at time t"""
+        return {module: float(v) for module, v in self.valuesAt(t).items()}
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Ring buffer of live frames in shared memory.
+
+One acquisition process publishes every frame once; viewers, live counting or
+drift monitors in other processes attach read-only and read the newest frames
+as zero-copy NumPy views instead of each fetching them from UView:
+
+    ring = sharedFrameRing.create("spleem_live", (ys, xs))
+    pipeline.addListener(ring)                  # acquisition process
+
+    ring = sharedFrameRing.attach("spleem_live")  # any other process
+    nr, img, metadata = ring.latest()
+
+Each slot carries a sequence number that is odd while the slot is being
+written (a seqlock), so a reader can tell whether the frame it read was
+overwritten in the meantime.
+"""
+
+import json
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = 0x5350_4C45_454D  # "SPLEEM"
+HEADER_SIZE = 64
+METADATA_SIZE = 4096
+# magic, nSlots, ys, xs, metadata size, frames published
+_HEADER_FIELDS = 6
+
+
+def _slotDtype(metadataSize):
+    return np.dtype(
+        [
+            ("seq", "<i8"),
+            ("index", "<i8"),
+            ("time", "<f8"),
+            ("startVoltage", "<f8"),
+            ("metadataLength", "<i8"),
+            ("metadata", f"S{metadataSize}"),
+        ]
+    )
+
+
+def _align(n, alignment=64):
+    return -(-n // alignment) * alignment
+
+
+class sharedFrameRing:
+    """nSlots uint16 frames of shape (ys, xs) plus their metadata in one shared
+    memory block. Use create in the publishing process and attach elsewhere."""
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        header = np.ndarray((_HEADER_FIELDS,), "<i8", shm.buf)
+        if header[0] != MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.nSlots, ys, xs, metadataSize = (int(x) for x in header[1:5])
+        self.shape = (ys, xs)
+        self.header = header
+        slotDtype = _slotDtype(metadataSize)
+        self.slots = np.ndarray((self.nSlots,), slotDtype, shm.buf, HEADER_SIZE)
+        self.frames = np.ndarray(
+            (self.nSlots, ys, xs),
+            "<u2",
+            shm.buf,
+            _align(HEADER_SIZE + self.nSlots * slotDtype.itemsize),
+        )
+        if not owner:
+            for array in (self.header, self.slots, self.frames):
+                array.flags.writeable = False
+
+    @classmethod
+    def create(
+        cls, name=None, shape=(1024, 1024), nSlots=16, metadataSize=METADATA_SIZE
+    ):
+        """Allocates a new ring. name=None lets the system pick one (see .name)."""
+        ys, xs = shape
+        slotsSize = nSlots * _slotDtype(metadataSize).itemsize
+        size = _align(HEADER_SIZE + slotsSize) + nSlots * ys * xs * 2
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((_HEADER_FIELDS,), "<i8", shm.buf)
+        header[:] = (MAGIC, nSlots, ys, xs, metadataSize, 0)
+        np.ndarray((nSlots,), _slotDtype(metadataSize), shm.buf, HEADER_SIZE)[:] = 0
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attaches read-only to the ring published under name"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before Python 3.13 every attaching process registers the block with
+            # its resource tracker, which unlinks it when that process exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the views; the publishing process also frees the block"""
+        del self.header, self.slots, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __call__(self, index, img, parameters):
+        """acquisitionPipeline listener signature"""
+        self.publish(img, index, parameters)
+
+    def publish(self, img, index=-1, parameters=None, startVoltage=None):
+        """Copies img into the next slot and returns its frame number"""
+        assert self.owner, "Only the process that created the ring can publish."
+        nr = int(self.header[5])
+        slot = self.slots[nr % self.nSlots : nr % self.nSlots + 1]
+        parameters = parameters or {}
+        if startVoltage is None:
+            startVoltage = parameters.get("Start Voltage")
+        metadata = json.dumps(parameters, default=str).encode("utf-8")
+        if len(metadata) > slot.dtype["metadata"].itemsize:
+            print("Frame metadata too long for the ring, dropped")
+            metadata = b"{}"
+
+        slot["seq"] = 2 * nr + 1
+        self.frames[nr % self.nSlots] = img
+        slot["index"] = index
+        slot["time"] = time.time()
+        slot["startVoltage"] = np.nan if startVoltage is None else startVoltage
+        slot["metadataLength"] = len(metadata)
+        slot["metadata"] = metadata
+        slot["seq"] = 2 * nr + 2
+        self.header[5] = nr + 1
+        return nr
+
+    def lastFrame(self):
+        """Number of the newest complete frame, -1 before the first one"""
+        return int(self.header[5]) - 1
+
+    def isValid(self, nr):
+        """True while frame nr has not been overwritten; check it after using a view
+        returned by view()"""
+        return self.slots[nr % self.nSlots]["seq"] == 2 * nr + 2
+
+    def view(self, nr):
+        """Zero-copy view of frame nr, or None if it is no longer in the ring. The
+        writer may reuse the slot at any time, see isValid."""
+        if nr < 0 or not self.isValid(nr):
+            return None
+        return self.frames[nr % self.nSlots]
+
+    def metadata(self, nr):
+        """Returns dict(index, time, startVoltage, parameters) of frame nr, or None
+        if it is no longer in the ring"""
+        if nr < 0:
+            return None
+        slot = self.slots[nr % self.nSlots]
+        entry = slot.copy()
+        if entry["seq"] != 2 * nr + 2 or not self.isValid(nr):
+            return None
+        raw = bytes(entry["metadata"])[: int(entry["metadataLength"])]
+        return {
+            "index": int(entry["index"]),
+            "time": float(entry["time"]),
+            "startVoltage": float(entry["startVoltage"]),
+            "parameters": json.loads(raw or b"{}"),
+        }
+
+    def read(self, nr, copy=False):
+        """Returns (img, metadata) of frame nr, or None if it was overwritten. With
+        copy=True the pixels are copied and checked to be consistent."""
+        metadata = self.metadata(nr)
+        img = self.view(nr)
+        if metadata is None or img is None:
+            return None
+        if copy:
+            img = img.copy()
+            if not self.isValid(nr):
+                return None
+        return img, metadata
+
+    def latest(self, copy=False):
+        """Returns (nr, img, metadata) of the newest frame, or None if there is none
+        yet"""
+        while (nr := self.lastFrame()) >= 0:
+            frame = self.read(nr, copy)
+            if frame is not None:
+                return (nr, *frame)
+        return None
+
+    def waitForFrame(self, after, timeout=None, poll=0.005):
+        """Blocks until a frame newer than after is published and returns its
+        number, or None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (nr := self.lastFrame()) <= after:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll)
+        return nr
+
+    def newFrames(self, after=-1, copy=False):
+        """Yields (nr, img, metadata) of the frames after after that are still in the
+        ring, oldest first"""
+        first = max(after + 1, self.lastFrame() - self.nSlots + 1)
+        for nr in range(first, self.lastFrame() + 1):
+            frame = self.read(nr, copy)
+            if frame is not None:
+                yield (nr, *frame)
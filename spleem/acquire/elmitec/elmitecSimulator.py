@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the LEEM2000 and UView control sockets.
+
+It speaks the text protocol used by elmitecConnect (nrm, nam, mne, get, set,
+psl, psh, chm, prl, ida, asi, aip, avr, ext, gcs, xmi, mar, ...) so oLeem, oUview
+and the asyncio clients can be exercised and benchmarked without the microscope:
+
+    with elmitecSimulator(latency=0.001, chunkSize=1400) as sim:
+        oec = elmitecConnect(ip=sim.ip, LEEMport=sim.leemPort, UVIEWport=sim.uviewPort)
+"""
+
+import socketserver
+import threading
+import time
+import numpy as np
+
+# number: (name, mnemonic, low limit, high limit, value)
+DEFAULT_MODULES = {
+    0: ("Start Voltage", "STV", -10.0, 100.0, 0.0),
+    1: ("Objective", "OBJ", 0.0, 2000.0, 1500.0),
+    2: ("Field Lens", "FL", 0.0, 5000.0, 2960.0),
+    3: ("Intermediate Lens", "IL", 0.0, 5000.0, 1200.0),
+    4: ("Projective 1", "P1", 0.0, 5000.0, 800.0),
+    5: ("Projective 2", "P2", 0.0, 5000.0, 900.0),
+    6: ("Illumination Deflector X", "ILDX", -100.0, 100.0, 0.0),
+    7: ("Illumination Deflector Y", "ILDY", -100.0, 100.0, 0.0),
+    8: ("Sample Temperature", "TEMP", 0.0, 2000.0, 300.0),
+    9: ("MCP", "MCP", 0.0, 2000.0, 1300.0),
+}
+
+
+def syntheticImage(frameNr, size, electrons=200, seed=None):
+    """A dark, noisy frame with bright single-electron spots, as (ys, xs) uint16"""
+    xs, ys = size
+    rng = np.random.default_rng(frameNr if seed is None else seed)
+    img = rng.poisson(100, (ys, xs)).astype(np.uint16)
+    y = rng.integers(1, ys - 1, electrons)
+    x = rng.integers(1, xs - 1, electrons)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            img[y + dy, x + dx] += 400 if dy == dx == 0 else 150
+    return img
+
+
+class _simulatorHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.sim = self.server.simulator
+        self.changed = {}
+        with self.sim.lock:
+            self.sim.clients.append(self)
+
+    def finish(self):
+        with self.sim.lock:
+            self.sim.clients.remove(self)
+
+    def handle(self):
+        buffer = b""
+        while True:
+            data = self.request.recv(65536)
+            if len(data) == 0:
+                return
+            buffer += data
+            if b"\0" in buffer:
+                *commands, buffer = buffer.split(b"\0")
+            else:
+                # clients that do not terminate their commands send one at a time
+                commands, buffer = [buffer], b""
+            for command in commands:
+                command = command.decode("utf-8").strip()
+                if command == "clo":
+                    return
+                if command:
+                    self.reply(self.sim.execute(command, self))
+
+    def reply(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("latin-1") + b"\0"
+        if self.sim.latency > 0:
+            time.sleep(self.sim.latency)
+        chunk = self.sim.chunkSize or len(payload)
+        for start in range(0, len(payload), chunk):
+            self.request.sendall(payload[start : start + chunk])
+        self.sim.stats["bytesSent"] += len(payload)
+
+
+class _simulatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class elmitecSimulator:
+    """Serves a simulated LEEM2000 and UView on two local ports.
+
+    modules maps module numbers to (name, mnemonic, low, high, value). latency
+    delays every reply, chunkSize splits replies into separate sends to mimic
+    partial packets, and imageFactory(frameNr, (xs, ys)) returns the (ys, xs)
+    uint16 frame delivered for each acquisition.
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        leemPort=0,
+        uviewPort=0,
+        modules=None,
+        imageSize=(1024, 1024),
+        imageFactory=None,
+        latency=0.0,
+        chunkSize=None,
+        acquisitionTime=0.0,
+        fov=15.0,
+    ):
+        self.ip = ip
+        self.leemPort = leemPort
+        self.uviewPort = uviewPort
+        self.modules = {
+            x: dict(zip(("name", "mnemonic", "low", "high", "value"), module))
+            for x, module in (modules or DEFAULT_MODULES).items()
+        }
+        self.imageSize = imageSize
+        self.imageFactory = imageFactory or syntheticImage
+        self.latency = latency
+        self.chunkSize = chunkSize
+        self.acquisitionTime = acquisitionTime
+        self.fov = fov
+        self.exposure = 100.0
+        self.avr = 0
+        self.acquiring = False
+        self.frameNr = 0
+        self.image = None
+        self.roi = [0, 0, imageSize[0] - 1, imageSize[1] - 1]
+        # number: (imgNr, typeNr, x1, y1, x2, y2)
+        self.markers = {}
+        self.clients = []
+        self.lock = threading.RLock()
+        self.stats = {"commands": 0, "bytesSent": 0, "images": 0}
+        self.servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        for attr in ("leemPort", "uviewPort"):
+            server = _simulatorServer((self.ip, getattr(self, attr)), _simulatorHandler)
+            server.simulator = self
+            setattr(self, attr, server.server_address[1])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def moduleNumber(self, module):
+        module = module.strip()
+        if module.lstrip("-").isdigit():
+            return int(module) if int(module) in self.modules else None
+        for x, m in self.modules.items():
+            if module.upper() in (m["name"].upper(), m["mnemonic"].upper()):
+                return x
+        return None
+
+    def setModule(self, module, value):
+        """Changes a module value as if it was done on the instrument; every
+        connected client sees it in its next chm reply"""
+        x = module if isinstance(module, int) else self.moduleNumber(module)
+        with self.lock:
+            self.modules[x]["value"] = float(value)
+            for client in self.clients:
+                client.changed[x] = float(value)
+
+    def addMarker(self, marker, typeNr=10, pos=(0, 0, 0, 0), imgNr=0):
+        with self.lock:
+            self.markers[marker] = (imgNr, typeNr, *pos)
+
+    def removeMarker(self, marker):
+        with self.lock:
+            self.markers.pop(marker, None)
+
+    def acquire(self):
+        if self.acquisitionTime > 0:
+            time.sleep(self.acquisitionTime)
+        with self.lock:
+            self.frameNr += 1
+            self.image = self.imageFactory(self.frameNr, self.imageSize)
+            self.stats["images"] += 1
+
+    def imageReply(self):
+        if self.image is None:
+            self.acquire()
+        ys, xs = self.image.shape
+        header = f"ida {xs} {ys}".ljust(19).encode("utf-8")
+        return header + self.image.astype("<u2").tobytes() + b"\0"
+
+    def execute(self, command, client):
+        self.stats["commands"] += 1
+        cmd, _, arg = command.partition(" ")
+        arg = arg.strip()
+        m = self.moduleNumber(arg) if arg else None
+
+        if cmd == "asc":
+            return "0"
+        elif cmd == "nrm":
+            return str(max(self.modules) + 1)
+        elif cmd in ("nam", "mne", "psl", "psh", "get"):
+            if m is None:
+                return "invalid"
+            key = {
+                "nam": "name",
+                "mne": "mnemonic",
+                "psl": "low",
+                "psh": "high",
+                "get": "value",
+            }[cmd]
+            return str(self.modules[m][key])
+        elif cmd == "set":
+            module, _, value = arg.partition("=")
+            m = self.moduleNumber(module)
+            try:
+                value = float(value)
+            except ValueError:
+                return "invalid"
+            if m is None:
+                return "invalid"
+            self.setModule(m, value)
+            return "0"
+        elif cmd == "chm":
+            with self.lock:
+                changed, client.changed = client.changed, {}
+            if not changed:
+                return "0"
+            pairs = " ".join(f"{x} {value}" for x, value in changed.items())
+            return f"{len(changed)} {pairs}"
+        elif cmd == "prl":
+            return f"{self.fov:g}\xb5m:LEEM"
+        elif cmd == "ida":
+            return self.imageReply()
+        elif cmd == "asi":
+            self.acquire()
+            return "0"
+        elif cmd == "aip":
+            if arg in ("0", "1"):
+                self.acquiring = arg == "1"
+                return "0"
+            return "1" if self.acquiring else "0"
+        elif cmd == "avr":
+            if arg:
+                self.avr = int(arg)
+                return "0"
+            return str(self.avr)
+        elif cmd == "ext":
+            if arg:
+                self.exposure = float(arg)
+                return "0"
+            return f"{self.exposure:g}"
+        elif cmd == "gcs":
+            return f"{self.imageSize[0]} {self.imageSize[1]}"
+        elif cmd in ("xmi", "ymi", "xma", "yma"):
+            return str(self.roi[("xmi", "ymi", "xma", "yma").index(cmd)])
+        elif cmd == "mar":
+            with self.lock:
+                if arg == "-1":
+                    return " ".join(str(x) for x in [len(self.markers), *self.markers])
+                if not arg.isdigit() or int(arg) not in self.markers:
+                    return "invalid"
+                return " ".join(str(x) for x in [arg, *self.markers[int(arg)]])
+        elif cmd == "exp":
+            return ""
+        return "invalid"
+
+
+if __name__ == "__main__":
+    with elmitecSimulator(leemPort=5566, uviewPort=5570) as sim:
+        print(f"Simulating LEEM2000 on {sim.ip}:5566 and UView on {sim.ip}:5570")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
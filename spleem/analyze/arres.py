@@ -2,8 +2,8 @@ import os
 import numpy as np
 from time import perf_counter
 from pathlib import Path
-from matplotlib import pyplot as plt
 from .imports import ReadUView
+from .correction import FlatFieldCorrection
 
 __all__ = ["extract_arres", "extract_all_arres"]
 
@@ -11,7 +11,11 @@ ARRES_FILENAME = "ARRES_data.csv"
 
 
 def extract_arres(
-    folder: Path, box_radius: int = 18, output_file: bool = True, n_sv: int = None
+    folder: Path,
+    box_radius: int = 18,
+    output_file: bool = True,
+    n_sv: int = None,
+    correction: FlatFieldCorrection = None,
 ):
     files = os.listdir(folder)
     if ARRES_FILENAME in files:
@@ -19,7 +23,7 @@ def extract_arres(
 
         return np.loadtxt(folder / ARRES_FILENAME, delimiter=",")
     else:
-        RU = ReadUView()
+        RU = ReadUView(correction)
 
         files = [file for file in files if file.endswith(".dat")]
         n_files = int(files[-1].split("_")[0]) + 1
@@ -91,6 +95,8 @@ def extract_all_arres(root: Path, plot: bool = True) -> dict[str, np.ndarray]:
                     data = extract_arres(Path(parent) / directory)
                     dataset[directory] = data
                     if plot:
+                        from matplotlib import pyplot as plt
+
                         plt.imshow(data)
                         plt.show()
             except Exception as e:
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+from pathlib import Path
+from dataclasses import dataclass
+from numpy.typing import NDArray
+from .imports import ReadUView
+
+__all__ = ["FlatFieldCorrection", "mean_frame"]
+
+CALIBRATION_FILENAME = "calibration_mean.npy"
+
+
+def mean_frame(folder: Path) -> NDArray:
+    """Averages every .tif/.dat frame of a calibration scan. The float32 result is
+    cached in the scan folder and read back on later calls."""
+    folder = Path(folder)
+    if (folder / CALIBRATION_FILENAME).exists():
+        return np.load(folder / CALIBRATION_FILENAME)
+
+    ru = ReadUView()
+    total: NDArray = None
+    n_frames = 0
+    for file in sorted(os.listdir(folder)):
+        if file.endswith(".tif"):
+            from PIL import Image as Tif
+
+            frames = [np.array(Tif.open(folder / file))]
+        elif file.endswith(".dat"):
+            frames = ru.getImage(folder / file)
+        else:
+            continue
+
+        for frame in frames:
+            if total is None:
+                total = np.zeros(frame.shape, dtype=np.float64)
+            total += frame
+            n_frames += 1
+
+    assert n_frames > 0, f"No calibration frames found in {folder}."
+    mean = (total / n_frames).astype(np.float32)
+    np.save(folder / CALIBRATION_FILENAME, mean)
+
+    return mean
+
+
+@dataclass
+class FlatFieldCorrection:
+    dark: NDArray
+    gain: NDArray
+    chunk_size: int = 64
+
+    @classmethod
+    def from_scans(cls, dark_folder: Path, flat_folder: Path, **kwargs):
+        """Builds the correction from a dark scan and a flat (uniform illumination)
+        scan. The gain normalizes the flat response to its mean; dead pixels get a
+        gain of zero."""
+        dark = mean_frame(dark_folder)
+        response = mean_frame(flat_folder) - dark
+        gain = np.zeros_like(response)
+        np.divide(response.mean(), response, out=gain, where=response > 0)
+
+        return cls(dark, gain, **kwargs)
+
+    def apply(self, raw: NDArray, out: NDArray = None) -> NDArray:
+        """Returns (raw - dark) * gain as float32 for a single frame or an (n, h, w)
+        stack. Stacks are processed chunk_size frames at a time to bound
+        temporaries; pass out=raw to correct a float32 stack in place."""
+        out = np.empty(raw.shape, dtype=np.float32) if out is None else out
+
+        frames = raw.reshape(-1, *self.dark.shape)
+        corrected = out.reshape(-1, *self.dark.shape)
+        for start in range(0, len(frames), self.chunk_size):
+            chunk = corrected[start : start + self.chunk_size]
+            np.subtract(
+                frames[start : start + self.chunk_size],
+                self.dark,
+                out=chunk,
+                casting="unsafe",
+            )
+            chunk *= self.gain
+
+        return out
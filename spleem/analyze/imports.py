@@ -42,11 +42,17 @@ from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from pathlib import Path
+    from .correction import FlatFieldCorrection
+
+# generous upper bound on file header + recipe + image header + LEEM data
+SPIN_HEADER_READ_SIZE = 4096
 
 
 class ReadUView:
-    def __init__(self) -> None:
-        """Initializes the ReadUView object"""
+    def __init__(self, correction: "FlatFieldCorrection" = None) -> None:
+        """Initializes the ReadUView object. If a correction is given, getImage
+        returns dark/flat corrected float32 images."""
+        self.correction = correction
 
     def __repr__(self):
         try:
@@ -98,8 +104,71 @@ class ReadUView:
         # print(tm.perf_counter()-t0)
         # ims.append(  np.reshape(  struct.unpack(str(w*h)+'H',self.fc[size-1-(n-j)*w*h*2:size-1-((n-j)-1)*w*h*2]), (h,w)  )  )
         # return self.fc
+        if self.correction is not None:
+            ims = list(self.correction.apply(np.array(ims)))
         return ims
 
+    def getSpinImages(self, fn) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """Returns the (up, down, combined) images of a three-image spin file
+        as uint16 views onto a single read-only memory map, plus the spin
+        field of the image header"""
+        # only the headers are needed, the image data stays on disk
+        self.readHeaders(fn)
+
+        if self.nrImages != 3:
+            raise ValueError(
+                f"{fn} holds {self.nrImages} images, spin files hold exactly 3."
+            )
+
+        mm = np.memmap(self.fn, dtype=np.uint8, mode="r")
+        head = self.headerSize
+        imhead = self.imageHeadersize + self.attachedMarkupSize + self.LEEMDataVersion
+        h = self.imageHeight
+        w = self.imageWidth
+        imsize = h * w * 2
+        imlen = imhead + imsize
+
+        # same layout as the n == 3 branch of getImage: the first two images
+        # follow their headers, the last one sits at the very end of the file
+        offsets = (head + imhead, head + imlen + imhead, mm.size - imsize)
+        up, down, combined = (
+            mm[offset : offset + imsize].view("<u2").reshape((h, w))
+            for offset in offsets
+        )
+        return up, down, combined, self.spin
+
+    def readHeaders(self, fn) -> None:
+        """Parses the file and image headers of fn without reading the image data"""
+        self.fn = fn
+        with open(self.fn, mode="rb") as file:
+            self.fc = file.read(SPIN_HEADER_READ_SIZE)
+
+        self.fh = self.fileHeader()
+        self.ih = self.imageHeader()
+
+    def readImageInto(self, fn, out: np.ndarray = None) -> np.ndarray:
+        """Reads the first image of fn as raw uint16 straight from the file into out,
+        a C-contiguous (imageHeight, imageWidth) array, which is allocated if None"""
+        self.readHeaders(fn)
+        h = self.imageHeight
+        w = self.imageWidth
+        if out is None:
+            out = np.empty((h, w), dtype="<u2")
+        elif out.shape != (h, w):
+            raise ValueError(f"{fn} holds ({h}, {w}) images, not {out.shape}.")
+
+        offset = (
+            self.headerSize
+            + self.imageHeadersize
+            + self.attachedMarkupSize
+            + self.LEEMDataVersion
+        )
+        with open(self.fn, mode="rb") as file:
+            file.seek(offset)
+            if file.readinto(memoryview(out).cast("B")) != h * w * 2:
+                raise ValueError(f"{fn} is truncated.")
+        return out
+
     def get_all_images(self, folder: "Path") -> list[np.ndarray]:
         frames = []
         for file in os.listdir(folder):
@@ -495,3 +564,13 @@ def load_all_images(folder: "Path") -> list:
             images.append(ru.getImage(folder / file))
 
     return images
+
+
+def load_all_spin_images(folder: "Path") -> list[tuple]:
+    ru = ReadUView()
+    images = []
+    for file in os.listdir(folder):
+        if file.endswith(".dat"):
+            images.append(ru.getSpinImages(folder / file))
+
+    return images
@@ -0,0 +1,169 @@
+import os
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from statistics import mean, stdev
+from typing import Callable, Optional
+from numpy.typing import NDArray
+
+__all__ = ["LiveElectronCounter", "find_electrons"]
+
+
+def find_electrons(data: NDArray, min_persistence=20) -> NDArray:
+    """Returns the (y, x) positions of the peaks whose persistence exceeds
+    min_persistence, as an (n, 2) array.
+
+    The persistence of a peak is its height above the highest saddle (8-connected)
+    joining it to a higher peak, i.e. its dynamic, so the peaks are the h-maxima of
+    the frame for h just above min_persistence. These come from a morphological
+    reconstruction in compiled code instead of the pure Python sort and union-find
+    of persistence.imagepers, which takes seconds per frame. A flat peak is
+    reported at its first pixel in row-major order."""
+    from scipy import ndimage
+    from skimage.morphology import h_maxima
+
+    data = np.asarray(data)
+    if data.dtype.kind in "ui":
+        h = np.floor(min_persistence) + 1
+    else:
+        h = np.nextafter(min_persistence, np.inf)
+    peaks = h_maxima(data, h, footprint=np.ones((3, 3))).astype(bool)
+    labels, _n_peaks = ndimage.label(peaks, structure=np.ones((3, 3)))
+    label, first = np.unique(labels.ravel(), return_index=True)
+    # label 0 is the background
+    positions = np.unravel_index(first[label > 0], data.shape)
+    return np.column_stack(positions).astype(np.intp).reshape(-1, 2)
+
+
+class LiveElectronCounter:
+    """Counts electrons in frames as they are acquired.
+
+    Frames are handed to a pool of worker processes. find_electrons takes about
+    20 ms for a 256x256 frame, 0.1 s for 512x512 and 0.55 s for 1024x1024 on one
+    core, so each worker counts roughly 2 full-size frames per second. While
+    max_pending frames are still being counted, newer frames are dropped instead
+    of queueing up behind the camera; status() reports how many were counted and
+    dropped, so a rate based on a small fraction of the frames is easy to spot.
+    The counter can be added directly as an acquisitionPipeline listener, or fed
+    from any frame source with watch:
+
+        with LiveElectronCounter(exposure=0.5) as counter:
+            counter.watch(uview.getImage, n_frames=100)
+            rate, error = counter.rate()
+    """
+
+    def __init__(
+        self,
+        exposure=1,
+        min_persistence=20,
+        window: int = 50,
+        workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+    ):
+        self.exposure = exposure
+        self.min_persistence = min_persistence
+        self.counts = deque(maxlen=window)
+        self.event_map: Optional[NDArray] = None
+        self.frames_counted = 0
+        self.frames_dropped = 0
+        self.listeners: list[Callable[[float, float], None]] = []
+
+        workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(workers)
+        self._max_pending = max_pending or 2 * workers
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __call__(self, index: int, data: NDArray, parameters: dict = None):
+        """acquisitionPipeline listener signature"""
+        self.submit(data)
+
+    def submit(self, data: NDArray) -> bool:
+        """Queues a frame for counting. The frame is copied, so the caller may reuse
+        its buffer. Returns False if the frame was dropped."""
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self.frames_dropped += 1
+                return False
+            self._pending += 1
+            if self.event_map is None:
+                self.event_map = np.zeros(np.shape(data), dtype=np.uint32)
+
+        future = self._executor.submit(
+            find_electrons, np.array(data), self.min_persistence
+        )
+        future.add_done_callback(self._collect)
+        return True
+
+    def _collect(self, future: Future):
+        try:
+            positions = future.result()
+        except Exception as e:
+            print(f"Electron counting failed: {e}")
+            positions = None
+
+        with self._lock:
+            self._pending -= 1
+            if positions is not None:
+                np.add.at(self.event_map, (positions[:, 0], positions[:, 1]), 1)
+                self.counts.append(len(positions) / self.exposure)
+                self.frames_counted += 1
+            self._idle.notify_all()
+            listeners = list(self.listeners)
+            rate = self._rate()
+
+        for callback in listeners:
+            callback(*rate)
+
+    def _rate(self) -> tuple[float, float]:
+        if not self.counts:
+            return (np.nan, np.nan)
+        if len(self.counts) == 1:
+            return (self.counts[0], np.nan)
+        return (mean(self.counts), stdev(self.counts) / np.sqrt(len(self.counts)))
+
+    def rate(self) -> tuple[float, float]:
+        """Mean count rate over the last window frames and its standard error"""
+        with self._lock:
+            return self._rate()
+
+    def status(self) -> dict:
+        """Returns the number of frames counted, dropped and still being counted"""
+        with self._lock:
+            return {
+                "frames_counted": self.frames_counted,
+                "frames_dropped": self.frames_dropped,
+                "pending": self._pending,
+            }
+
+    def add_listener(self, callback: Callable[[float, float], None]):
+        """Calls callback(rate, error) from a worker callback thread every time a
+        frame has been counted"""
+        self.listeners.append(callback)
+        return callback
+
+    def watch(self, get_image: Callable[[], NDArray], n_frames: int = None):
+        """Feeds frames from get_image (e.g. oUview.getImage while UView acquires
+        continuously) to the counter until n_frames have been submitted, or forever
+        if n_frames is None"""
+        submitted = 0
+        while n_frames is None or submitted < n_frames:
+            self.submit(get_image())
+            submitted += 1
+
+    def wait(self):
+        """Blocks until every submitted frame has been counted"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
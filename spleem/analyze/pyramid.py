@@ -0,0 +1,79 @@
+import numpy as np
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Callable
+from numpy.typing import NDArray
+
+__all__ = ["Pyramid", "bin_image", "cached_pyramid", "fitting_factor"]
+
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def bin_image(data: NDArray, factor: int) -> NDArray:
+    """Sums factor x factor blocks of pixels. Edge rows/columns that do not fill a
+    whole block are dropped. Integer data is summed in at least uint32."""
+    h, w = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[: h * factor, : w * factor].reshape(h, factor, w, factor)
+    return blocks.sum(axis=(1, 3), dtype=np.promote_types(data.dtype, np.uint32))
+
+
+def fitting_factor(
+    shape: tuple[int, int],
+    window: tuple[int, int],
+    factors: tuple[int, ...] = PYRAMID_FACTORS,
+) -> int:
+    """Returns the factor of the largest level that fits inside window, the same
+    level Pyramid.level_for(window, within=True) picks, without binning anything"""
+    for factor in (1, *sorted(factors)):
+        if shape[0] // factor <= window[0] and shape[1] // factor <= window[1]:
+            return factor
+
+    return max(factors)
+
+
+@dataclass
+class Pyramid:
+    levels: dict[int, NDArray] = field(default_factory=dict)
+
+    @classmethod
+    def build(cls, data: NDArray, factors: tuple[int, ...] = PYRAMID_FACTORS):
+        """Bins the image to every factor in one pass, each level being binned from
+        the finest level it is a multiple of"""
+        levels = {1: data}
+        for factor in sorted(factors):
+            source = max(f for f in levels if factor % f == 0)
+            levels[factor] = bin_image(levels[source], factor // source)
+
+        return cls(levels)
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as archive:
+            return cls({int(key): archive[key] for key in archive.files})
+
+    def save(self, path: Path):
+        np.savez(path, **{str(factor): level for factor, level in self.levels.items()})
+
+    def level_for(self, shape: tuple[int, int], within: bool = False) -> NDArray:
+        """Returns the smallest level that still covers shape. With within=True it
+        instead returns the largest level that fits inside shape, so it can be shown
+        without any resampling."""
+        for factor in sorted(self.levels, reverse=not within):
+            level = self.levels[factor]
+            fits = level.shape[0] <= shape[0] and level.shape[1] <= shape[1]
+            covers = level.shape[0] >= shape[0] and level.shape[1] >= shape[1]
+            if (within and fits) or (not within and covers):
+                return level
+
+        return self.levels[max(self.levels) if within else 1]
+
+
+def cached_pyramid(path: Path, data: Callable[[], NDArray]) -> Pyramid:
+    """Loads the pyramid stored at path, or builds it from data() and stores it"""
+    path = Path(path)
+    if path.exists():
+        return Pyramid.load(path)
+
+    pyramid = Pyramid.build(data())
+    pyramid.save(path)
+    return pyramid
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+from numpy.typing import NDArray
+
+__all__ = ["estimate_shifts", "shift_frame"]
+
+
+def _window(shape: tuple[int, int]) -> NDArray:
+    """Separable Hann window that suppresses the edge discontinuity of the FFT"""
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _batches(frames: Iterable[NDArray], batch_size: int) -> Iterator[NDArray]:
+    iterator = iter(frames)
+    while batch := list(islice(iterator, batch_size)):
+        yield np.stack(batch).astype(np.float32)
+
+
+def _batch_shifts(batch: NDArray, reference_fft: NDArray, window: NDArray) -> NDArray:
+    from scipy import fft
+
+    shape = batch.shape[1:]
+    if window is not None:
+        batch *= window
+
+    # normalized cross-power spectrum, computed in place on the batch spectrum
+    cross = fft.rfft2(batch, axes=(-2, -1), overwrite_x=True)
+    cross *= reference_fft
+    cross /= np.abs(cross) + np.finfo(np.float32).eps
+    correlation = fft.irfft2(cross, s=shape, axes=(-2, -1), overwrite_x=True)
+
+    n = len(batch)
+    peak_y, peak_x = np.unravel_index(correlation.reshape(n, -1).argmax(axis=1), shape)
+    rows = np.arange(n)
+
+    # parabolic sub-pixel refinement along each axis around the peak
+    shifts = np.empty((n, 2))
+    for axis, (peak, size) in enumerate(zip((peak_y, peak_x), shape)):
+        before, after = (peak - 1) % size, (peak + 1) % size
+        if axis == 0:
+            c_before = correlation[rows, before, peak_x]
+            c_after = correlation[rows, after, peak_x]
+        else:
+            c_before = correlation[rows, peak_y, before]
+            c_after = correlation[rows, peak_y, after]
+        c_peak = correlation[rows, peak_y, peak_x]
+        curvature = c_before - 2 * c_peak + c_after
+        offset = np.divide(
+            c_before - c_after,
+            2 * curvature,
+            out=np.zeros(n),
+            where=curvature != 0,
+        )
+        drift = peak + np.clip(offset, -0.5, 0.5)
+        drift[drift > size / 2] -= size
+        shifts[:, axis] = -drift
+
+    return shifts
+
+
+def estimate_shifts(
+    frames: Iterable[NDArray],
+    reference: NDArray,
+    batch_size: int = 16,
+    workers: int = None,
+    window: bool = True,
+) -> NDArray:
+    """Estimates the (row, column) shift that aligns each frame onto the reference
+    with FFT phase correlation.
+
+    Frames are consumed lazily in batches, the reference spectrum is computed once
+    and the batches are transformed in parallel by a thread pool. Returns an
+    (n_frames, 2) array of sub-pixel shifts.
+    """
+    from scipy import fft
+
+    workers = os.cpu_count() if workers is None else workers
+    apodization = _window(reference.shape) if window else None
+
+    prepared_reference = reference.astype(np.float32)
+    if apodization is not None:
+        prepared_reference *= apodization
+    reference_fft = np.conj(fft.rfft2(prepared_reference))
+
+    shifts = []
+    # bound the number of queued batches so long stacks are never all in memory
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in _batches(frames, batch_size):
+            pending.append(
+                pool.submit(_batch_shifts, batch, reference_fft, apodization)
+            )
+            if len(pending) > 2 * workers:
+                shifts.append(pending.popleft().result())
+        shifts.extend(future.result() for future in pending)
+
+    return np.concatenate(shifts) if shifts else np.zeros((0, 2))
+
+
+def shift_frame(data: NDArray, shift) -> NDArray:
+    """Returns the frame translated by the shift rounded to whole pixels, with the
+    uncovered border filled with zeros"""
+    dy, dx = (int(round(s)) for s in shift)
+    if dy == 0 and dx == 0:
+        return data
+
+    h, w = data.shape
+    shifted = np.zeros_like(data)
+    shifted[max(dy, 0) : h + min(dy, 0), max(dx, 0) : w + min(dx, 0)] = data[
+        max(-dy, 0) : h + min(-dy, 0), max(-dx, 0) : w + min(-dx, 0)
+    ]
+    return shifted
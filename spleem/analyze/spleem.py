@@ -1,14 +1,20 @@
 import re, os
+import json
 from pathlib import Path
-import matplotlib.pyplot as plt
 import numpy as np
-from typing import Union
+from typing import TYPE_CHECKING, Union
 from numpy.typing import NDArray
-from PIL import Image as Tif  # I want the name Image
-from scipy.interpolate import interp1d
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from statistics import mean, stdev
-from .persistence.imagepers import persistence
+from .registration import estimate_shifts, shift_frame
+from .correction import FlatFieldCorrection
+from .pyramid import Pyramid, cached_pyramid
+from .live_counting import find_electrons
+
+# matplotlib, scipy.interpolate and PIL are imported where they are used, so
+# headless workers that never plot do not pay for them
+if TYPE_CHECKING:
+    import matplotlib.pyplot as plt
 
 __all__ = [
     "Frame",
@@ -20,8 +26,15 @@ __all__ = [
     "test_electron_counting",
     "load_scan",
     "load_all",
+    "ScanCatalogue",
+    "ScanProxy",
+    "scan_catalogue",
+    "plot_overview",
 ]
 
+PYRAMID_FILENAME = "pyramid_{}_{}_{}.npz"
+CATALOGUE_FILENAME = "scan_catalogue.json"
+
 
 @dataclass
 class Frame:
@@ -40,6 +53,8 @@ class Frame:
         self.index = self.metadata.pop("index")
         self.start_voltage = self.metadata.pop("Start_Voltage")
 
+        from PIL import Image as Tif  # I want the name Image
+
         self.data = np.array(Tif.open(path))
 
     def _read_metadata(self, filename) -> dict:
@@ -58,6 +73,8 @@ class Frame:
         return self._prune_metadata(data)
 
     def _prune_metadata(self, data: dict) -> dict:
+        from scipy.interpolate import interp1d
+
         del data["directory"]
         del data["file"]
         if self.start_voltage_table is None:
@@ -90,6 +107,14 @@ class Image:
     folder: Path
     start_voltage_table: list = None
     frames: list[Frame] = None
+    shifts: NDArray = field(default=None, init=False, repr=False)
+    correction: FlatFieldCorrection = field(default=None, init=False, repr=False)
+    _prefix_sums: tuple[int, NDArray] = field(default=None, init=False, repr=False)
+    _corrected: NDArray = field(default=None, init=False, repr=False)
+
+    # memory allowed for the prefix sums before falling back to block sums, and for
+    # the corrected frames before correcting them again on every read
+    INTEGRATION_CACHE_BYTES = 2 * 1024**3
 
     def __post_init__(self):
         if not isinstance(self.folder, Path):
@@ -109,25 +134,146 @@ class Image:
     def _valid_file(self, filename: str):
         return filename.endswith(".tif")
 
-    def plot_image(
-        self, frame_slice: slice = None, vmin=None, vmax=None, ax: plt.Axes = None
-    ):
-        frame_slice = (
-            frame_slice if frame_slice is not None else slice(len(self.frames))
+    def frame_data(self, index: int, registered: bool = True) -> NDArray:
+        """Returns the data of a frame, dark/flat corrected if a correction is set and
+        shifted onto the reference if the image has been registered"""
+        if self._corrected is not None:
+            data = self._corrected[index]
+        elif self.correction is not None:
+            data = self.correction.apply(self.frames[index].data)
+        else:
+            data = self.frames[index].data
+        if registered and self.shifts is not None:
+            data = shift_frame(data, self.shifts[index])
+        return data
+
+    def set_correction(self, correction: FlatFieldCorrection = None):
+        """Applies the dark/flat-field correction to every frame read from now on.
+        Corrected frames are float32, so integrated images become float64. The
+        stack is corrected once, chunk by chunk, if it fits in
+        INTEGRATION_CACHE_BYTES; larger stacks are corrected frame by frame as
+        they are read. Pass None to go back to raw counts."""
+        self.correction = correction
+        self._corrected = None
+        self._prefix_sums = None
+
+        n_frames = len(self.frames)
+        if correction is None or n_frames == 0:
+            return self
+        shape = self.frames[0].data.shape
+        if n_frames * np.prod(shape) * 4 > self.INTEGRATION_CACHE_BYTES:
+            return self
+
+        corrected = np.empty((n_frames, *shape), dtype=np.float32)
+        for start in range(0, n_frames, correction.chunk_size):
+            stop = min(start + correction.chunk_size, n_frames)
+            raw = np.stack([frame.data for frame in self.frames[start:stop]])
+            correction.apply(raw, out=corrected[start:stop])
+        corrected.flags.writeable = False
+        self._corrected = corrected
+
+        return self
+
+    def register(self, reference: int = 0, **kwargs) -> NDArray:
+        """Estimates the drift of every frame against the reference frame. The shifts
+        are stored and applied whenever frame data is read."""
+        self.shifts = estimate_shifts(
+            (self.frame_data(i, registered=False) for i in range(len(self.frames))),
+            self.frame_data(reference, registered=False),
+            **kwargs,
+        )
+        self._prefix_sums = None
+        return self.shifts
+
+    def _build_prefix_sums(self) -> tuple[int, NDArray]:
+        """Accumulates the frames once into checkpoints holding the sum of all
+        preceding frames, one checkpoint every `block` frames. With enough memory
+        block is 1 and every checkpoint is a full prefix sum."""
+        n_frames = len(self.frames)
+        first = self.frame_data(0)
+        dtype = np.float64 if first.dtype.kind == "f" else np.int64
+        checkpoint_bytes = first.size * np.dtype(dtype).itemsize
+
+        # the block never grows past the stack, whatever the budget
+        budget = self.INTEGRATION_CACHE_BYTES
+        block = 1
+        while block < n_frames and (n_frames // block + 1) * checkpoint_bytes > budget:
+            block *= 2
+
+        checkpoints = np.empty((n_frames // block + 1, *first.shape), dtype=dtype)
+        running = np.zeros(first.shape, dtype=dtype)
+        for index in range(n_frames):
+            if index % block == 0:
+                checkpoints[index // block] = running
+            np.add(running, self.frame_data(index), out=running)
+        if n_frames % block == 0:
+            checkpoints[-1] = running
+
+        return block, checkpoints
+
+    def _prefix_sum(self, stop: int) -> NDArray:
+        block, checkpoints = self._prefix_sums
+        total = checkpoints[stop // block].copy()
+        for index in range(stop - stop % block, stop):
+            np.add(total, self.frame_data(index), out=total)
+        return total
+
+    def integrated_image(self, frame_slice: slice = None) -> NDArray:
+        """Returns the sum of the frames in frame_slice, accumulated in int64 (float64
+        for float data, e.g. with a correction set) so long acquisitions cannot
+        overflow"""
+        frame_slice = frame_slice if frame_slice is not None else slice(None)
+        start, stop, step = frame_slice.indices(len(self.frames))
+
+        if self._prefix_sums is None:
+            self._prefix_sums = self._build_prefix_sums()
+
+        if step == 1:
+            total = self._prefix_sum(max(stop, start))
+            total -= self._prefix_sum(start)
+            return total
+
+        _block, checkpoints = self._prefix_sums
+        total = np.zeros_like(checkpoints[0])
+        for index in range(start, stop, step):
+            np.add(total, self.frame_data(index), out=total)
+        return total
+
+    def pyramid(self, frame_slice: slice = None) -> Pyramid:
+        """Returns the 2x/4x/8x binned pyramid of the integrated image. Pyramids of
+        uncorrected, unregistered data are cached in the scan folder."""
+        frame_slice = frame_slice if frame_slice is not None else slice(None)
+        if self.correction is not None or self.shifts is not None:
+            return Pyramid.build(self.integrated_image(frame_slice))
+
+        start, stop, step = frame_slice.indices(len(self.frames))
+        return cached_pyramid(
+            self.folder / PYRAMID_FILENAME.format(start, stop, step),
+            lambda: self.integrated_image(frame_slice),
         )
 
-        integrated_image: np.ndarray = None  # TODO clean this up
-        for frame in self.frames[frame_slice]:
-            integrated_image = (
-                frame.data
-                if integrated_image is None
-                else integrated_image + frame.data
+    def plot_image(
+        self,
+        frame_slice: slice = None,
+        vmin=None,
+        vmax=None,
+        ax: "plt.Axes" = None,
+        resolution: int = None,
+    ):
+        """Plots the normalized integrated image. Given a resolution, the smallest
+        pyramid level covering resolution x resolution pixels is plotted instead."""
+        if resolution is None:
+            integrated_image = self.integrated_image(frame_slice)
+        else:
+            integrated_image = self.pyramid(frame_slice).level_for(
+                (resolution, resolution)
             )
-
         integrated_image = integrated_image - integrated_image.min()
         integrated_image = integrated_image / integrated_image.max()
 
         if ax == None:
+            import matplotlib.pyplot as plt
+
             fig, ax = plt.subplots()
             ax.imshow(integrated_image, vmin=vmin, vmax=vmax)
             return fig, ax
@@ -144,11 +290,11 @@ class Sweep(Image):
 
         intensity = []
         voltage = []
-        for frame in self.frames:
+        for index, frame in enumerate(self.frames):
             if voltage_range is None or (
                 voltage_range[0] <= frame.start_voltage <= voltage_range[1]
             ):
-                frame_intensity = frame.data[x_slice, y_slice].sum()
+                frame_intensity = self.frame_data(index)[x_slice, y_slice].sum()
                 if frame.start_voltage in voltage:
                     intensity[-1] += frame_intensity
                 else:
@@ -165,7 +311,7 @@ class Sweep(Image):
 
     def iv_curve(
         self,
-        ax: plt.Axes = None,
+        ax: "plt.Axes" = None,
         voltage_range=None,
         x_slice=None,
         y_slice=None,
@@ -177,6 +323,8 @@ class Sweep(Image):
         )
 
         if ax == None:
+            import matplotlib.pyplot as plt
+
             fig, ax = plt.subplots()
             ax.plot(voltage, intensity)
             ax.set_xlabel("start voltage [V]")
@@ -200,12 +348,12 @@ class SpinSweep(Sweep):
 
     def _import_image(self):
         frame_sets = {
-            "[SPLEEM]": self.frames,
-            "[SPINUP]": self.up_frames,
-            "[SPINDN]": self.down_frames,
+            "[SPLEEM]": "frames",
+            "[SPINUP]": "up_frames",
+            "[SPINDN]": "down_frames",
         }
 
-        for spin, frame_set in frame_sets:
+        for spin, attribute in frame_sets.items():
             file_list = [
                 Path(file)
                 for file in os.listdir(self.folder)
@@ -215,6 +363,7 @@ class SpinSweep(Sweep):
             for file in file_list:
                 frame = Frame(self.folder / file)
                 frame_set[frame.index - 1] = frame
+            setattr(self, attribute, frame_set)
 
     def _valid_file(self, filename: str, spin: str):
         return filename.endswith(".tif") and spin in filename
@@ -300,16 +449,10 @@ class SpinSweep(Sweep):
 
 
 def electron_rate(image: Image, exposure=1, min_persistence=20) -> tuple[float, float]:
-    n_peaks = []
-    for frame in image.frames:
-        peak_data = persistence(frame.data)
-
-        peak_count = 0
-        for homology_class in peak_data:
-            _birth_point, _birth_level, pers, _death_point = homology_class
-            if pers > min_persistence:
-                peak_count += 1
-        n_peaks.append(peak_count / exposure)
+    n_peaks = [
+        len(find_electrons(frame.data, min_persistence)) / exposure
+        for frame in image.frames
+    ]
 
     return (mean(n_peaks), stdev(n_peaks))
 
@@ -317,16 +460,14 @@ def electron_rate(image: Image, exposure=1, min_persistence=20) -> tuple[float,
 def test_electron_counting(
     image: Image, min_persistence=20, test_frame: int = 0, **kwargs
 ):
+    import matplotlib.pyplot as plt
+
     ax: list[plt.Axes]
     fig, ax = plt.subplots(1, 2, figsize=(14, 7))
     ax[0].imshow(image.frames[test_frame].data, **kwargs)
 
-    peak_data = persistence(image.frames[test_frame].data)
-    for homology_class in peak_data:
-        birth_point, _birth_level, pers, _death_point = homology_class
-        y, x = birth_point
-        if pers > min_persistence:
-            ax[1].plot(x, y, "k.")
+    y, x = find_electrons(image.frames[test_frame].data, min_persistence).T
+    ax[1].plot(x, y, "k.")
 
     ax[1].set_title(f"Peak Locations with Persistence>{min_persistence}")
     ax[1].set_xlim(0, image.frames[test_frame].data.shape[1])
@@ -337,42 +478,177 @@ def test_electron_counting(
     return fig, ax
 
 
-def load_scan(folder, desired_index: int):
-    for root, dirs, _files in os.walk(folder):
-        for directory in dirs:
-            index: str = directory[:2]
-            if index.isdigit():
-                index = int(index)
-                if index == desired_index:
-                    if "IM" in directory:
-                        return Image(Path(root) / Path(directory))
-                    elif "SW" in directory:
-                        return Sweep(Path(root) / Path(directory))
-                    elif "SRSW" in directory:
-                        return SpinSweep(Path(root) / Path(directory))
-                    elif "SR" in directory:
-                        return SpinImage(Path(root) / Path(directory))
+def plot_overview(
+    scans: dict[int, Image], resolution: int = 256, columns: int = 4, **kwargs
+):
+    """Plots a mosaic of the integrated images of several scans, e.g. the output of
+    load_all, each read from the smallest pyramid level covering resolution"""
+    import matplotlib.pyplot as plt
+
+    rows = -(-len(scans) // columns)
+    ax: np.ndarray
+    fig, ax = plt.subplots(
+        rows, columns, figsize=(3 * columns, 3 * rows), squeeze=False
+    )
+    for axis in ax.flat:
+        axis.set_axis_off()
+
+    for axis, (index, scan) in zip(ax.flat, sorted(scans.items())):
+        scan.plot_image(ax=axis, resolution=resolution, **kwargs)
+        axis.set_title(f"{index}: {scan.folder.name}")
+
+    return fig, ax
+
+
+# most specific tag first: "SRSW" contains both "SR" and "SW"
+SCAN_TYPES = {"SRSW": SpinSweep, "SR": SpinImage, "SW": Sweep, "IM": Image}
+
+
+def scan_type(directory: str) -> str:
+    """Returns the scan type tag in a scan folder name, or None"""
+    for tag in SCAN_TYPES:
+        if tag in directory:
+            return tag
+    return None
+
+
+@dataclass
+class ScanProxy:
+    """Stands in for a scan and loads it on first use; any attribute of the scan is
+    available on the proxy"""
+
+    index: int
+    folder: Path
+    scan_type: str
+    _scan: Image = field(default=None, init=False, repr=False)
+
+    def load(self) -> Image:
+        if self._scan is None:
+            self._scan = SCAN_TYPES[self.scan_type](self.folder)
+        return self._scan
+
+    @property
+    def loaded(self) -> bool:
+        return self._scan is not None
+
+    def __getattr__(self, name):
+        # only called for attributes the proxy does not have itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+@dataclass
+class ScanCatalogue:
+    """Index -> (folder, scan type) of every scan below root, found in a single
+    directory walk and stored in root/CATALOGUE_FILENAME for later sessions"""
+
+    root: Path
+    scans: dict[int, tuple[Path, str]] = field(default_factory=dict)
+    _proxies: dict[int, ScanProxy] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        self.root = Path(self.root)
+
+    @classmethod
+    def build(cls, root) -> "ScanCatalogue":
+        catalogue = cls(root)
+        for parent, dirs, _files in os.walk(catalogue.root):
+            for directory in dirs:
+                index: str = directory[:2]
+                tag = scan_type(directory)
+                if index.isdigit() and tag is not None:
+                    # the first folder found for an index wins
+                    catalogue.scans.setdefault(
+                        int(index), (Path(parent) / directory, tag)
+                    )
+        return catalogue
+
+    @classmethod
+    def load(cls, root, refresh: bool = False) -> "ScanCatalogue":
+        """Reads the stored catalogue of root, or builds and stores it"""
+        path = Path(root) / CATALOGUE_FILENAME
+        if path.exists() and not refresh:
+            with open(path) as f:
+                stored = json.load(f)
+            return cls(
+                root,
+                {
+                    int(index): (Path(root) / folder, tag)
+                    for index, (folder, tag) in stored.items()
+                },
+            )
+
+        catalogue = cls.build(root)
+        catalogue.save()
+        return catalogue
+
+    def save(self):
+        stored = {
+            index: (str(folder.relative_to(self.root)), tag)
+            for index, (folder, tag) in sorted(self.scans.items())
+        }
+        try:
+            with open(self.root / CATALOGUE_FILENAME, "w") as f:
+                json.dump(stored, f, indent=1)
+        except OSError as e:
+            print(f"Could not store the scan catalogue in {self.root}: {e}")
+
+    def refresh(self):
+        """Walks root again, keeping the proxies of scans that did not move"""
+        self.scans = ScanCatalogue.build(self.root).scans
+        self._proxies = {
+            index: proxy
+            for index, proxy in self._proxies.items()
+            if self.scans.get(index, (None,))[0] == proxy.folder
+        }
+        self.save()
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.scans
+
+    def __len__(self) -> int:
+        return len(self.scans)
+
+    def __getitem__(self, index: int) -> ScanProxy:
+        if index not in self._proxies:
+            folder, tag = self.scans[index]
+            self._proxies[index] = ScanProxy(index, folder, tag)
+        return self._proxies[index]
+
+    def select(self, inclusions: tuple[int, ...] = None) -> dict[int, ScanProxy]:
+        indices = (
+            self.scans if inclusions is None else set(inclusions) & set(self.scans)
+        )
+        return {index: self[index] for index in sorted(indices)}
+
+
+_catalogues: dict[Path, ScanCatalogue] = {}
+
+
+def scan_catalogue(folder, refresh: bool = False) -> ScanCatalogue:
+    """Returns the catalogue of folder, shared by every call in this session"""
+    root = Path(folder).resolve()
+    if refresh or root not in _catalogues:
+        _catalogues[root] = ScanCatalogue.load(root, refresh=refresh)
+    return _catalogues[root]
+
+
+def load_scan(folder, desired_index: int) -> Union[Image, None]:
+    """Loads the scan with the given index below folder. The folder is only walked
+    when the catalogue does not know the index yet, and the loaded scan is kept,
+    so repeated calls are dictionary lookups."""
+    catalogue = scan_catalogue(folder)
+    if desired_index not in catalogue or not catalogue[desired_index].folder.is_dir():
+        catalogue.refresh()
+    if desired_index not in catalogue:
+        return None
+    return catalogue[desired_index].load()
 
 
 def load_all(
-    folder, inclusions: tuple[int, ...] = None
-) -> dict[int : Union[Image, Sweep, SpinImage, SpinSweep]]:
-    if inclusions is not None:
-        inclusions = set(inclusions)  # probably isnt meaningful but its fun
-
-    scans = {}
-    for root, dirs, _files in os.walk(folder):
-        for directory in dirs:
-            index: str = directory[:2]
-            if index.isdigit():
-                index = int(index)
-                if (inclusions == None) or (index in inclusions):
-                    if "IM" in directory:
-                        scans[index] = Image(Path(root) / Path(directory))
-                    elif "SW" in directory:
-                        scans[index] = Sweep(Path(root) / Path(directory))
-                    elif "SRSW" in directory:
-                        scans[index] = SpinSweep(Path(root) / Path(directory))
-                    elif "SR" in directory:
-                        scans[index] = SpinImage(Path(root) / Path(directory))
-    return scans
+    folder, inclusions: tuple[int, ...] = None, refresh: bool = False
+) -> dict[int, ScanProxy]:
+    """Returns index -> ScanProxy of the scans below folder; each scan is loaded
+    when it is first used"""
+    return scan_catalogue(folder, refresh=refresh).select(inclusions)
@@ -0,0 +1,71 @@
+"""Checks that importing spleem stays cheap.
+
+Each module is imported in a fresh interpreter, which must not pull in
+matplotlib, scipy, skimage, tkinter or PIL, and whose best-of-3 import time
+must stay within BUDGET seconds of a bare `import numpy`. Exits non-zero on any
+failure. Run from the repository root: python tools/check_import_time.py
+"""
+
+import subprocess
+import sys
+
+MODULES = (
+    "spleem",
+    "spleem.analyze.spleem",
+    "spleem.analyze.arres",
+    "spleem.analyze.correction",
+    "spleem.analyze.registration",
+    "spleem.analyze.live_counting",
+    "spleem.analyze.pyramid",
+    "spleem.acquire",
+    "spleem.acquire.elmitec.elmitecAcquisition",
+    "spleem.acquire.elmitec.elmitecAnalysis",
+    "spleem.acquire.elmitec.elmitecAsync",
+    "spleem.acquire.elmitec.elmitecConnect",
+    "spleem.acquire.elmitec.elmitecParameterLog",
+    "spleem.acquire.elmitec.elmitecSharedFrames",
+)
+HEAVY = ("matplotlib", "scipy", "skimage", "tkinter", "PIL")
+BUDGET = 0.1  # seconds on top of `import numpy`
+REPEATS = 3
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = sorted({{name.split(".")[0] for name in sys.modules}} & set({heavy!r}))
+print(elapsed, ",".join(heavy))
+"""
+
+
+def probe(module):
+    """Returns (seconds, heavy modules loaded) for one cold import of module"""
+    code = _PROBE.format(module=module, heavy=HEAVY)
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(out[0]), out[1].split(",") if len(out) > 1 else []
+
+
+def main():
+    baseline = min(probe("numpy")[0] for _ in range(REPEATS))
+    print(f"numpy                                         {baseline:.3f} s")
+    failed = False
+    for module in MODULES:
+        runs = [probe(module) for _ in range(REPEATS)]
+        best = min(seconds for seconds, _ in runs)
+        heavy = sorted({name for _, loaded in runs for name in loaded})
+        problems = []
+        if heavy:
+            problems.append("loads " + ", ".join(heavy))
+        if best - baseline > BUDGET:
+            problems.append(f"{best - baseline:.3f} s over numpy")
+        failed |= bool(problems)
+        status = "; ".join(problems) if problems else "ok"
+        print(f"{module:<45} {best:.3f} s  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())